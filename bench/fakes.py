@@ -0,0 +1,513 @@
+"""In-memory stand-ins for Discord, the extractor pool and Postgres."""
+import asyncio
+import hashlib
+import itertools
+import os
+import shutil
+import subprocess
+import threading
+import time
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+import discord
+
+from utils.cache import normalize_query
+from utils.store import columns
+
+_ids = itertools.count(10 ** 17)
+
+
+def snowflake():
+    return next(_ids)
+
+
+def make_fixture(path, *, seconds=30):
+    """Renders a sine tone to an ogg opus file with ffmpeg."""
+    subprocess.run(['ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-f', 'lavfi',
+                    '-i', f'sine=frequency=440:duration={seconds}', '-c:a', 'libopus', '-b:a', '128k', path],
+                   check=True)
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_directory(directory):
+    """Serves `directory` over http on a thread, returns the server and its base url."""
+    handler = type('Handler', (_QuietHandler,), {})
+    # SimpleHTTPRequestHandler only takes a directory from 3.7 on
+    handler.translate_path = lambda self, path: os.path.join(directory, os.path.basename(path.split('?')[0]))
+    server = _Server(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, name='bench-http', daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+class FakePermissions:
+    def __getattr__(self, name):
+        return True
+
+
+class FakeRole:
+    def __init__(self, name):
+        self.id = snowflake()
+        self.name = name
+        self.mention = f'<@&{self.id}>'
+
+
+class FakeMember:
+    def __init__(self, guild, name, *, bot=False, roles=(), id=None):
+        self.id = id or snowflake()
+        self.guild = guild
+        self.name = self.display_name = name
+        self.bot = bot
+        self.roles = list(roles)
+        self.voice = None
+        self.mention = f'<@{self.id}>'
+        self.avatar_url = ''
+
+    def __str__(self):
+        return self.name
+
+
+class FakeVoiceInfo:
+    def __init__(self, channel):
+        self.channel = channel
+        self.deaf = self.self_deaf = False
+        self.mute = self.self_mute = False
+
+
+class FakeMessage:
+    def __init__(self, world, channel, author, content='', *, embed=None):
+        self.world = world
+        self.id = snowflake()
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.embed = embed
+        self.attachments = []
+        self.mentions = []
+        self.role_mentions = []
+        self._state = None
+
+    async def add_reaction(self, emoji):
+        await self.world.api_call()
+
+    async def remove_reaction(self, emoji, member):
+        await self.world.api_call()
+
+    async def clear_reactions(self):
+        await self.world.api_call()
+
+    async def edit(self, *, content=None, embed=None):
+        await self.world.api_call()
+        self.embed = embed
+
+    async def delete(self):
+        await self.world.api_call()
+
+
+class FakeTextChannel:
+    def __init__(self, world, guild, name):
+        self.world = world
+        self.id = snowflake()
+        self.guild = guild
+        self.name = name
+        self.last_message_id = None
+        self.sent = 0
+        self._reply_waiters = []
+
+    def __str__(self):
+        return self.name
+
+    def permissions_for(self, member):
+        return FakePermissions()
+
+    def next_reply(self):
+        """A future set to the next message sent in this channel."""
+        fut = asyncio.get_event_loop().create_future()
+        self._reply_waiters.append(fut)
+        return fut
+
+    async def send(self, content=None, *, embed=None, **kwargs):
+        await self.world.api_call()
+        message = FakeMessage(self.world, self, self.guild.me, content, embed=embed)
+        self.last_message_id = message.id
+        self.sent += 1
+        waiters, self._reply_waiters = self._reply_waiters, []
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(message)
+        return message
+
+    async def delete_messages(self, messages):
+        await self.world.api_call()
+
+
+class FakeVoiceChannel:
+    def __init__(self, world, guild, name):
+        self.world = world
+        self.id = snowflake()
+        self.guild = guild
+        self.name = name
+        self.members = []
+
+    def __str__(self):
+        return self.name
+
+    async def connect(self):
+        await self.world.api_call()
+        self.guild.voice_client = FakeVoiceClient(self.world, self)
+        self.members.append(self.guild.me)
+        self.world.move(self.guild.me, self)
+        return self.guild.voice_client
+
+
+class _Player(threading.Thread):
+    """Reads a source on its own thread like discord's AudioPlayer, without sending anything."""
+    def __init__(self, client, source, after):
+        super().__init__(daemon=True, name=f'bench-player-{client.guild.id}')
+        self.client = client
+        self.source = source
+        self.after = after
+        self._end = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+
+    def run(self):
+        world = self.client.world
+        error = None
+        try:
+            frames = 0
+            while not self._end.is_set() and (world.frames is None or frames < world.frames):
+                if not self._resumed.is_set():
+                    self._resumed.wait()
+                    continue
+                if not self.source.read():
+                    break
+                frames += 1
+                if world.frame_delay:
+                    time.sleep(world.frame_delay)
+        except Exception as e:
+            error = e
+        finally:
+            self._end.set()
+            self.source.cleanup()
+            self.client.finished()
+            if self.after is not None:
+                self.after(error)
+
+    def is_playing(self):
+        return not self._end.is_set() and self._resumed.is_set()
+
+    def is_paused(self):
+        return not self._end.is_set() and not self._resumed.is_set()
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    def stop(self):
+        self._end.set()
+        self._resumed.set()
+
+
+class FakeVoiceClient:
+    def __init__(self, world, channel):
+        self.world = world
+        self.channel = channel
+        self.guild = channel.guild
+        self._player = None
+        self._ended = None  # when the last song finished, to time the gap to the next
+
+    @property
+    def source(self):
+        return self._player.source if self._player else None
+
+    @source.setter
+    def source(self, value):
+        if self._player is not None:
+            self._player.source = value
+
+    def play(self, source, *, after=None):
+        if self.is_playing():
+            raise discord.ClientException('Already playing audio.')
+        if self._ended is not None:
+            self.world.gaps.append(time.perf_counter() - self._ended)
+            self._ended = None
+        self._player = _Player(self, source, after)
+        self._player.start()
+
+    def finished(self):
+        self._ended = time.perf_counter()
+        self.world.song_finished()
+
+    def is_playing(self):
+        return self._player is not None and self._player.is_playing()
+
+    def is_paused(self):
+        return self._player is not None and self._player.is_paused()
+
+    def pause(self):
+        if self._player is not None:
+            self._player.pause()
+
+    def resume(self):
+        if self._player is not None:
+            self._player.resume()
+
+    def stop(self):
+        if self._player is not None:
+            self._player.stop()
+            self._player = None
+
+    async def move_to(self, channel):
+        await self.world.api_call()
+        if self.guild.me in self.channel.members:
+            self.channel.members.remove(self.guild.me)
+        channel.members.append(self.guild.me)
+        self.channel = channel
+        self.world.move(self.guild.me, channel)
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        await self.world.api_call()
+        if self.guild.me in self.channel.members:
+            self.channel.members.remove(self.guild.me)
+        self.guild.voice_client = None
+        self.world.move(self.guild.me, None)
+
+
+class FakeGuild:
+    def __init__(self, world, name):
+        self.world = world
+        self.id = snowflake()
+        self.name = name
+        self.me = FakeMember(self, world.user.name, bot=True, id=world.user.id)
+        self.roles = [FakeRole('DJ')]
+        self.members = [self.me]
+        self.voice_client = None
+        self.text_channel = FakeTextChannel(world, self, 'music')
+        self.voice_channel = FakeVoiceChannel(world, self, 'Music')
+
+    @property
+    def master_role(self):
+        return self.roles[0]
+
+    @property
+    def people(self):
+        return [m for m in self.members if not m.bot]
+
+    def add_member(self, name, *, in_voice=True, master=False):
+        member = FakeMember(self, name, roles=[self.master_role] if master else ())
+        self.members.append(member)
+        self.world.users[member.id] = member
+        if in_voice:
+            member.voice = FakeVoiceInfo(self.voice_channel)
+            self.voice_channel.members.append(member)
+        return member
+
+    def get_member(self, user_id):
+        return discord.utils.get(self.members, id=user_id)
+
+    def get_member_named(self, name):
+        return discord.utils.get(self.members, name=name)
+
+    def get_role(self, role_id):
+        return discord.utils.get(self.roles, id=role_id)
+
+
+class World:
+    """Every fake guild the bot can see, and how the fake voice clients play.
+    `frames` caps how many packets of a song are played, `frame_delay` paces
+    them (0.02 is real time). `api_latency` is added to every Discord call.
+    """
+    def __init__(self, *, api_latency=0.0, frames=None, frame_delay=0.0, loop=None):
+        self.api_latency = api_latency
+        self.frames = frames
+        self.frame_delay = frame_delay
+        self.loop = loop or asyncio.get_event_loop()
+        self.user = FakeMember(None, 'ShinoBot', bot=True)
+        self.guilds = {}
+        self.users = {self.user.id: self.user}
+        self.gaps = []  # seconds between one song ending and the next starting
+        self.bot = None  # gets the voice state updates, set by the harness
+        self.played = 0
+        self._played_waiters = []
+
+    def add_guild(self, name, *, members=5):
+        guild = FakeGuild(self, name)
+        self.guilds[guild.id] = guild
+        for i in range(members):
+            guild.add_member(f'{name}-member{i}', master=i == 0)
+        return guild
+
+    async def api_call(self):
+        await asyncio.sleep(self.api_latency)
+
+    def move(self, member, channel):
+        """Puts a member in a voice channel, or out of voice with None, and tells the bot."""
+        before = member.voice or FakeVoiceInfo(None)
+        member.voice = FakeVoiceInfo(channel) if channel is not None else None
+        if self.bot is not None:
+            self.bot.dispatch('voice_state_update', member, before, member.voice or FakeVoiceInfo(None))
+
+    def song_finished(self):
+        self.loop.call_soon_threadsafe(self._count_played)
+
+    def _count_played(self):
+        self.played += 1
+        for target, fut in list(self._played_waiters):
+            if self.played >= target and not fut.done():
+                fut.set_result(None)
+
+    async def wait_played(self, target):
+        if self.played >= target:
+            return
+        fut = self.loop.create_future()
+        self._played_waiters.append((target, fut))
+        await fut
+
+
+class FakeExtractor:
+    """Answers like ExtractorPool, with made up songs that all point at the fixture file."""
+    def __init__(self, *, fixture, url, latency=0.0, duration=30, playlist_size=50):
+        self.fixture = fixture
+        self.url = url
+        self.latency = latency
+        self.duration = duration
+        self.playlist_size = playlist_size
+        self.calls = 0
+        self._running = 0
+        self._by_url = {}  # webpage url -> info, so re-resolving a song gives the same one
+
+    @property
+    def backlog(self):
+        return self._running
+
+    async def _work(self):
+        self.calls += 1
+        self._running += 1
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self._running -= 1
+
+    def info(self, query):
+        info = self._by_url.get(query)
+        if info is not None:
+            return dict(info)
+        song_id = hashlib.md5(normalize_query(query).encode()).hexdigest()[:11]
+        info = {'id': song_id, 'extractor': 'bench', 'extractor_key': 'Bench', 'title': f'Bench song {song_id}',
+                'duration': self.duration, 'url': self.url, 'webpage_url': f'https://bench.invalid/{song_id}',
+                'ext': 'opus', 'acodec': 'opus', 'abr': 128, 'protocol': 'http'}
+        self._by_url[info['webpage_url']] = info
+        return dict(info)
+
+    async def extract(self, query, *, guild_id=None):
+        await self._work()
+        return self.info(query)
+
+    async def playlist(self, url, *, limit=None, guild_id=None):
+        await self._work()
+        entries = []
+        for i in range(min(limit or self.playlist_size, self.playlist_size)):
+            info = self.info(f'{url}#{i}')
+            entries.append({k: info[k] for k in ('id', 'title', 'duration', 'webpage_url')})
+        return {'title': url, 'entries': entries}
+
+    async def download(self, data, template, *, guild_id=None):
+        await self._work()
+        filename = template % data
+        if not os.path.exists(filename):
+            shutil.copyfile(self.fixture, filename)
+        return filename
+
+    def cancel_guild(self, guild_id):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Transaction:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class _Acquire:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __await__(self):
+        return self.pool._connect().__await__()
+
+    async def __aenter__(self):
+        return await self.pool._connect()
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class FakePool:
+    """Enough of an asyncpg pool (and its connections) for the bot, tables are kept in dicts."""
+    def __init__(self, *, latency=0.0):
+        self.latency = latency
+        self.queries = 0
+        self.config = {}  # guild_id -> row
+
+    async def _roundtrip(self):
+        self.queries += 1
+        await asyncio.sleep(self.latency)  # still yields with no latency, like a real query
+
+    async def _connect(self):
+        await self._roundtrip()
+        return self
+
+    def acquire(self):
+        return _Acquire(self)
+
+    async def release(self, connection):
+        pass
+
+    def transaction(self):
+        return _Transaction()
+
+    async def add_listener(self, channel, callback):
+        pass
+
+    async def remove_listener(self, channel, callback):
+        pass
+
+    async def fetchrow(self, query, *args):
+        await self._roundtrip()
+        if 'FROM config' in query:
+            return self.config.get(args[0])
+        return None
+
+    async def fetch(self, query, *args):
+        await self._roundtrip()
+        return []
+
+    async def execute(self, query, *args):
+        await self._roundtrip()
+
+    async def executemany(self, query, rows):
+        await self._roundtrip()
+        if 'INTO config' in query:
+            for guild_id, *values in rows:
+                self.config[guild_id] = dict(zip(columns, values), guild_id=guild_id)
+
+    async def close(self):
+        pass
@@ -0,0 +1,164 @@
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+import asyncpg
+
+os.environ.setdefault('TOKEN', 'bench')  # keeps bot.py from reading config.yaml
+os.environ.setdefault('DATABASE_URL', 'postgres://bench')
+
+from bot import MusicBot, MusicContext, prefixes  # noqa: E402
+from bench.fakes import FakeExtractor, FakeMessage, FakePool, World  # noqa: E402
+from utils.catalog import TrackCatalog  # noqa: E402
+from utils.ratelimit import RateLimiter  # noqa: E402
+from utils.snapshots import QueueSnapshots  # noqa: E402
+from utils.store import ConfigStore  # noqa: E402
+
+
+class _Typing:
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class BenchContext(MusicContext):
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    def typing(self):
+        return _Typing()
+
+
+class BenchBot(MusicBot):
+    """The real bot, looking at fake guilds instead of a gateway connection."""
+    def __init__(self, world, **options):
+        super().__init__(**options)
+        self.world = world
+        self.errors = []
+
+    @property
+    def user(self):
+        return self.world.user
+
+    @property
+    def guilds(self):
+        return list(self.world.guilds.values())
+
+    @property
+    def voice_clients(self):
+        return [g.voice_client for g in self.world.guilds.values() if g.voice_client is not None]
+
+    def get_guild(self, guild_id):
+        return self.world.guilds.get(guild_id)
+
+    def get_user(self, user_id):
+        return self.world.users.get(user_id)
+
+    async def wait_until_ready(self):
+        pass
+
+    async def change_presence(self, **kwargs):
+        pass
+
+    async def get_context(self, message, *, cls=None):
+        return await super().get_context(message, cls=BenchContext)
+
+    async def on_command_error(self, ctx, error):
+        self.errors.append(error)
+        if len(self.errors) <= 3:
+            print(f"Error in {ctx.message.content}:", file=sys.stderr)
+            traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+
+
+class Harness:
+    """A bot wired to fakes, set up the way `on_ready` sets up the real one."""
+    def __init__(self, options, *, frames=None, frame_delay=0.0):
+        self.options = options
+        self.frames = frames
+        self.frame_delay = frame_delay
+        self.directory = None
+        self.world = None
+        self.bot = None
+
+    async def __aenter__(self):
+        o = self.options
+        loop = asyncio.get_event_loop()
+        self.directory = tempfile.mkdtemp(prefix='shinobot-bench-')
+        self.world = World(api_latency=o.api_latency, frames=self.frames, frame_delay=self.frame_delay, loop=loop)
+        self.bot = bot = BenchBot(self.world, command_prefix=list(prefixes), description="Music Bot", loop=loop)
+        self.world.bot = bot
+        bot.dev = False
+        bot.settings = {
+            'download': o.download,
+            'opus': not o.pcm,
+            'cache_dir': os.path.join(self.directory, 'cache'),
+            'presence': 'off',
+            'playlist_max': o.playlist,
+        }
+        # the bench sends far more than any member could
+        bot.user_limiter = RateLimiter(10 ** 9, 10 ** 9)
+        bot.guild_limiter = RateLimiter(10 ** 9, 10 ** 9)
+        bot.load_extension("cogs.music")
+        bot.load_extension("cogs.config")
+        bot.extractor = FakeExtractor(fixture=o.fixture, url=o.fixture_url, latency=o.extract_latency,
+                                      playlist_size=o.playlist)
+        bot.pool = await asyncpg.create_pool(o.dsn) if o.dsn else FakePool(latency=o.db_latency)
+        bot.configs = ConfigStore(bot.pool, in_use=lambda guild_id: guild_id in bot.states, loop=loop)
+        await bot.configs.setup()
+        await bot.configs.listen()
+        bot.configs.start()
+        bot.catalog = TrackCatalog(bot.pool, loop=loop)
+        await bot.catalog.setup()
+        bot.catalog.start()
+        bot.snapshots = QueueSnapshots(bot, loop=loop)
+        await bot.snapshots.setup()
+        bot.snapshots.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        bot = self.bot
+        await bot.snapshots.close()
+        for guild in self.world.guilds.values():
+            if guild.voice_client is not None:
+                guild.voice_client.stop()
+        for state in bot.states.values():
+            for song in state.queue.clear():
+                song.cleanup()
+        await bot.configs.close()
+        await bot.catalog.close()
+        if self.options.dsn:
+            await bot.pool.close()
+        current = asyncio.Task.current_task()
+        tasks = [t for t in asyncio.Task.all_tasks() if t is not current]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        if bot.errors:
+            print(f"{len(bot.errors)} commands failed.", file=sys.stderr)
+
+    async def add_guilds(self, n, *, members=5):
+        guilds = []
+        for i in range(n):
+            guild = self.world.add_guild(f'guild{i}', members=members)
+            await self.bot.configs.set(guild.id, 'role_id', guild.master_role.id)
+            guilds.append(guild)
+        return guilds
+
+    async def command(self, member, content):
+        """Sends a command, returns the seconds until the bot replied or finished handling it."""
+        channel = member.guild.text_channel
+        message = FakeMessage(self.world, channel, member, content)
+        reply = channel.next_reply()
+        start = time.perf_counter()
+        task = self.bot.loop.create_task(self.bot.on_message(message))
+        await asyncio.wait([task, reply], return_when=asyncio.FIRST_COMPLETED)
+        elapsed = time.perf_counter() - start
+        reply.cancel()
+        return elapsed
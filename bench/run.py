@@ -0,0 +1,104 @@
+"""Offline benchmarks, run with `python -m bench.run` from the repository root."""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+from bench.fakes import make_fixture, serve_directory
+from bench.scenarios import scenarios
+from bench.stats import table
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Runs the bot against fake Discord, extractor and database.")
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help=f"scenarios to run, all by default ({', '.join(scenarios)})")
+    parser.add_argument('--guilds', type=int, default=20, help="guilds active at once")
+    parser.add_argument('--members', type=int, default=5, help="members in each guild's voice channel")
+    parser.add_argument('--songs', type=int, default=10, help="songs each guild plays in the play scenario")
+    parser.add_argument('--playlist', type=int, default=50, help="songs in every playlist")
+    parser.add_argument('--queue-size', type=int, default=1000, help="songs in the queue the pages scenario renders")
+    parser.add_argument('--repeat', type=int, default=10, help="rounds of commands per guild")
+    parser.add_argument('--frames', type=int, default=25, help="packets played of each song in transitions")
+    parser.add_argument('--timeout', type=float, default=300, help="seconds to wait for playlists to finish")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="seconds added to every discord call")
+    parser.add_argument('--extract-latency', type=float, default=0.0, help="seconds every extraction takes")
+    parser.add_argument('--db-latency', type=float, default=0.0, help="seconds every fake query takes")
+    parser.add_argument('--dsn', help="use this postgres database instead of a fake one")
+    parser.add_argument('--download', action='store_true', help="download songs instead of streaming them")
+    parser.add_argument('--pcm', action='store_true', help="decode to pcm in the bot instead of using opus")
+    parser.add_argument('--fixture', help="audio file every song plays, a generated tone by default")
+    parser.add_argument('--out', help="write the results here instead of stdout")
+    parser.add_argument('--compare', help="results of an earlier run to show the changes against")
+    options = parser.parse_args(argv)
+    unknown = set(options.scenarios) - set(scenarios)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    options.scenarios = options.scenarios or list(scenarios)
+    return options
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    loop = asyncio.get_event_loop()
+    workdir = tempfile.mkdtemp(prefix='shinobot-bench-')
+    results = OrderedDict()
+    try:
+        if options.fixture is None:
+            options.fixture = os.path.join(workdir, 'fixture.opus')
+            make_fixture(options.fixture)
+        server, base_url = serve_directory(os.path.dirname(os.path.abspath(options.fixture)))
+        options.fixture_url = f'{base_url}/{os.path.basename(options.fixture)}'
+        try:
+            for name in options.scenarios:
+                print(f"Running {name}...", file=sys.stderr)
+                results.update(loop.run_until_complete(scenarios[name](options)).summary())
+        finally:
+            server.shutdown()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = OrderedDict([
+        ('meta', OrderedDict([
+            ('revision', git_revision()),
+            ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+            ('python', platform.python_version()),
+            ('platform', platform.platform()),
+            ('options', {k: v for k, v in vars(options).items() if k not in ('fixture_url', 'out', 'compare')}),
+        ])),
+        ('results', results),
+    ])
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+    print(table(results, baseline), file=sys.stderr)
+
+    if options.out:
+        with open(options.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import asyncio
+import sys
+import time
+from collections import OrderedDict
+
+from bench.fakes import FakeMessage
+from bench.harness import Harness
+from bench.stats import Recorder
+from cogs.music import QueueSource
+from utils.paginator import Pages
+from utils.resources import Song
+from utils.tracks import TrackQueue
+
+
+async def play(o):
+    """Every guild queues songs at once while songs play in real time, then queues them again from the info cache."""
+    async with Harness(o, frame_delay=0.02) as h:
+        guilds = await h.add_guilds(o.guilds, members=o.members)
+        rec = Recorder('play')
+
+        async def run(guild, op):
+            people = guild.people
+            for i in range(o.songs):
+                rec.add(op, await h.command(people[i % len(people)], f'm!play bench song {guild.id} {i}'))
+
+        await asyncio.gather(*(run(g, 'play') for g in guilds))
+        await asyncio.gather(*(run(g, 'play_cached') for g in guilds))
+        rec.stop()
+        return rec
+
+
+async def queue(o):
+    """The queue commands against full queues, pages included."""
+    async with Harness(o, frame_delay=0.02) as h:
+        guilds = await h.add_guilds(o.guilds, members=o.members)
+        await asyncio.gather(*(h.command(g.people[0], f'm!playlist bench playlist {g.id}') for g in guilds))
+        await asyncio.sleep(0.1)  # let the enqueued messages go out
+
+        commands = (
+            ('queue', 'm!queue'),
+            ('myqueue', 'm!myqueue'),
+            ('np', 'm!np'),
+            ('notify', 'm!notify 2'),
+            ('remove', 'm!remove 3'),
+            ('unqueue', 'm!unqueue'),
+        )
+        rec = Recorder('queue')
+
+        async def run(guild):
+            member = guild.people[0]
+            for _ in range(o.repeat):
+                for op, content in commands:
+                    rec.add(op, await h.command(member, content))
+
+        await asyncio.gather(*(run(g) for g in guilds))
+        rec.stop()
+        return rec
+
+
+async def transitions(o):
+    """Whole playlists played back to back, timing the silence between songs."""
+    async with Harness(o, frames=o.frames) as h:
+        guilds = await h.add_guilds(o.guilds, members=o.members)
+        rec = Recorder('transitions')
+
+        async def run(guild):
+            rec.add('playlist', await h.command(guild.people[0], f'm!playlist bench transitions {guild.id}'))
+
+        await asyncio.gather(*(run(g) for g in guilds))
+        try:
+            await asyncio.wait_for(h.world.wait_played(len(guilds) * o.playlist), o.timeout)
+        except asyncio.TimeoutError:
+            print(f"Only {h.world.played} of {len(guilds) * o.playlist} songs played.", file=sys.stderr)
+        rec.extend('gap', h.world.gaps)
+        rec.stop()
+        return rec
+
+
+async def pages(o):
+    """Rendering queue pages, cold, cached and after the queue changed."""
+    async with Harness(o) as h:
+        guild = (await h.add_guilds(1, members=o.members))[0]
+        member = guild.people[0]
+        q = TrackQueue()
+        for i in range(o.queue_size):
+            q.put(Song(h.bot.extractor.info(f'pages {i}'), requester=member, channel=guild.text_channel))
+        message = FakeMessage(h.world, guild.text_channel, member, 'm!queue')
+        rec = Recorder('pages')
+
+        async def show(op, p, page):
+            start = time.perf_counter()
+            await p.show_page(page)
+            rec.add(op, time.perf_counter() - start)
+
+        for i in range(o.repeat):
+            p = Pages(h.bot, message=message, source=QueueSource(q))
+            start = time.perf_counter()
+            await p.show_page(1, first=True)
+            rec.add('first', time.perf_counter() - start)
+            for page in range(1, p.maximum_pages + 1):
+                await show('cold', p, page)
+            for page in range(1, p.maximum_pages + 1):
+                await show('cached', p, page)
+            q.put(Song(h.bot.extractor.info(f'pages extra {i}'), requester=member, channel=guild.text_channel))
+            await show('changed', p, p.maximum_pages)
+        rec.stop()
+        return rec
+
+
+async def config(o):
+    """The config cog's commands, then writing and loading configs."""
+    async with Harness(o) as h:
+        guilds = await h.add_guilds(o.guilds, members=o.members)
+        rec = Recorder('config')
+
+        async def run(guild):
+            master, other = guild.people[0], guild.people[1]
+            for i in range(o.repeat):
+                for op, content in (
+                    ('config', f'm!config songs_max {50 + i}'),
+                    ('config', 'm!config length_max 600'),
+                    ('lock', f'm!lock {other.id}'),
+                    ('locked', 'm!locked text'),
+                    ('unlock', f'm!unlock {other.id}'),
+                    ('setmaster', f'm!setmaster {guild.master_role.id}'),
+                ):
+                    rec.add(op, await h.command(master, content))
+
+        await asyncio.gather(*(run(g) for g in guilds))
+
+        start = time.perf_counter()
+        await h.bot.configs.flush()
+        rec.add('flush', time.perf_counter() - start)
+
+        # guilds the store hasn't seen yet, then the same ones from memory
+        new = [h.world.add_guild(f'new{i}', members=1).id for i in range(o.guilds)]
+        for op in ('load_cold', 'load_warm'):
+            for guild_id in new:
+                start = time.perf_counter()
+                await h.bot.configs.load(guild_id)
+                rec.add(op, time.perf_counter() - start)
+        rec.stop()
+        return rec
+
+
+scenarios = OrderedDict([
+    ('play', play),
+    ('queue', queue),
+    ('transitions', transitions),
+    ('pages', pages),
+    ('config', config),
+])
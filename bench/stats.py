@@ -0,0 +1,71 @@
+import time
+from collections import OrderedDict
+
+
+def percentile(ordered, p):
+    """Nearest rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    rank = max(int(round(p / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class Recorder:
+    """Latency samples of one scenario, grouped by operation."""
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.samples = OrderedDict()  # operation -> list of seconds
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def add(self, op, seconds):
+        self.samples.setdefault(op, []).append(seconds)
+
+    def extend(self, op, seconds):
+        self.samples.setdefault(op, []).extend(seconds)
+
+    def stop(self):
+        self.finished = time.perf_counter()
+
+    @property
+    def wall(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def summary(self):
+        results = OrderedDict()
+        for op, samples in self.samples.items():
+            ordered = sorted(samples)
+            ms = lambda s: round(s * 1000, 3) if s is not None else None  # noqa
+            results[f'{self.scenario}.{op}'] = OrderedDict([
+                ('count', len(ordered)),
+                ('throughput', round(len(ordered) / self.wall, 2) if self.wall else None),  # per second
+                ('mean_ms', ms(sum(ordered) / len(ordered)) if ordered else None),
+                ('p50_ms', ms(percentile(ordered, 50))),
+                ('p95_ms', ms(percentile(ordered, 95))),
+                ('p99_ms', ms(percentile(ordered, 99))),
+                ('max_ms', ms(ordered[-1] if ordered else None)),
+            ])
+        return results
+
+
+def _change(old, new):
+    if old is None or new is None:
+        return ''
+    if not old:
+        return ' (new)' if new else ''
+    return ' ({:+.1f}%)'.format((new - old) / old * 100)
+
+
+def table(results, baseline=None):
+    """Formats results for the terminal, with the change from `baseline` if given."""
+    baseline = baseline or {}
+    lines = ['{:<32} {:>8} {:>20} {:>22} {:>22} {:>22}'.format(
+        'operation', 'count', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms')]
+    for op, r in results.items():
+        old = baseline.get(op, {})
+        cols = []
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            cols.append('{}{}'.format(r[key], _change(old.get(key), r[key])))
+        lines.append('{:<32} {:>8} {:>20} {:>22} {:>22} {:>22}'.format(
+            op, r['count'], '{}{}'.format(r['throughput'], _change(old.get('throughput'), r['throughput'])), *cols))
+    return '\n'.join(lines)
@@ -1,4 +1,6 @@
+import asyncio
 import os
+import time
 from ssl import SSLContext
 
 import asyncpg
@@ -6,26 +8,33 @@ import discord
 import yaml
 from discord.ext import commands
 
+from utils import metrics
+from utils.catalog import TrackCatalog
+from utils.health import LoopMonitor
+from utils.ipc import ClusterIPC
+from utils.ratelimit import RateLimiter
 from utils.resources import VoiceState
+from utils.snapshots import QueueSnapshots
+from utils.store import ConfigStore
 
 token = os.environ.get("TOKEN")
 db = os.environ.get("DATABASE_URL")
 dev = False
+settings = {}
 if token is None or db is None:
     with open("config.yaml") as cfg:
         cfg = yaml.load(cfg)
         token = cfg["token"]
         db = cfg["DB"]
         dev = cfg["dev"]
+        settings = cfg.get("settings") or {}
+
+prefixes = ("m!", "M!")
 
 
 class MusicContext(commands.Context):
     def get_state(self, guild_id):
-        state = self.bot.states.get(guild_id)
-        if state is None:
-            state = VoiceState(self.bot, guild_id)
-            self.bot.states[guild_id] = state
-        return state
+        return self.bot.get_state(guild_id)
 
     @property
     def state(self):
@@ -33,47 +42,168 @@ class MusicContext(commands.Context):
 
     @property
     def config(self):
-        if self.bot.config.get(self.guild.id) is None:
-            self.bot.config[self.guild.id] = {'role_id': None, 'songs_max': None, 'length_max': None, 'locked': None}
-        return self.bot.config[self.guild.id]
+        return self.bot.configs.get(self.guild.id)
+
+    @property
+    def master(self):
+        role_id = self.config['role_id']
+        return self.guild.get_role(role_id) if role_id else None
+
 
+class MusicBot(commands.AutoShardedBot):
+    ipc = None  # set when running as part of a cluster
+    worker_id = None
+    metrics_server = None
+    monitor = None
+    _setup_done = False
+    _command_table = None
+
+    def add_command(self, command):
+        super().add_command(command)
+        self._command_table = None
+
+    def remove_command(self, name):
+        command = super().remove_command(name)
+        self._command_table = None
+        return command
+
+    @property
+    def command_table(self):
+        """Commands and aliases by lowercased name, rebuilt only when commands change."""
+        if self._command_table is None:
+            self._command_table = {name.lower(): cmd for name, cmd in self.all_commands.items()}
+        return self._command_table
+
+    def get_state(self, guild_id):
+        state = self.states.get(guild_id)
+        if state is None:
+            state = VoiceState(self, guild_id)
+            self.states[guild_id] = state
+        return state
+
+    def local_stats(self):
+        return {
+            'shards': list(self.shard_ids or range(self.shard_count or 1)),
+            'guilds': len(self.guilds),
+            'voice': len(self.voice_clients),
+            'states': len(getattr(self, 'states', ())),
+            'latency': self.latency,
+        }
+
+    def register_gauges(self):
+        metrics.voice_states.func = lambda: len(self.states)
+        metrics.playing.func = lambda: sum(1 for vc in self.voice_clients if vc.is_playing())
+        metrics.queued_songs.func = lambda: sum(len(state.queue) for state in self.states.values())
+        metrics.extractor_backlog.func = lambda: self.extractor.backlog
+        metrics.resolves_active.func = lambda: self.admission.active
+        metrics.resolves_waiting.func = lambda: self.admission.backlog
+        if hasattr(self.pool, 'get_size'):  # only on newer asyncpg
+            metrics.db_pool_size.func = self.pool.get_size
+            metrics.db_pool_idle.func = self.pool.get_idle_size
 
-class MusicBot(commands.Bot):
     async def on_message(self, message):
+        # almost nothing is a command, drop those before doing any real work
+        if not message.content.startswith(prefixes) or message.guild is None or message.author.bot:
+            return
+        received = time.perf_counter()
+
         await self.wait_until_ready()
         if self.dev:
             if message.guild.id != 246291440106340352:
                 return
 
+        # spam is dropped before it can reach the extractors or the database
+        if not self.user_limiter.allow(message.author.id) or not self.guild_limiter.allow(message.guild.id):
+            return
+
         ctx = await self.get_context(message, cls=MusicContext)
         if ctx.prefix is not None:
-            ctx.command = self.all_commands.get(ctx.invoked_with.lower())
+            ctx.command = self.command_table.get(ctx.invoked_with.lower())
+            await self.configs.load(message.guild.id)
+            await self.snapshots.restore(message.guild.id)  # a queue from before a restart comes first
             await self.invoke(ctx)
+            if ctx.command is not None:
+                metrics.command_seconds.labels(ctx.command.qualified_name).observe(time.perf_counter() - received)
 
     async def on_ready(self):
         print('Logged in as {0.id}/{0}'.format(self.user))
         print('Dev mode state: ' + ('enabled' if dev else 'disabled'))
         print('------')
+        if self._setup_done:
+            return  # ready again after a shard re-identified, everything is still running
+        self._setup_done = True
         self.dev = dev
+        self.settings = settings
+        if settings.get('stall_threshold', 0.25) and self.monitor is None:
+            self.monitor = LoopMonitor(self.loop, threshold=settings.get('stall_threshold', 0.25))
+            self.monitor.start()
+        self.user_limiter = RateLimiter(settings.get('user_rate', 0.5), settings.get('user_burst', 5))
+        self.guild_limiter = RateLimiter(settings.get('guild_rate', 2), settings.get('guild_burst', 10))
         self.load_extension("cogs.music")
         self.load_extension("cogs.config")
+        self.load_extension("cogs.admin")
         self.pool = await asyncpg.create_pool(db, min_size=4, max_size=9, ssl=SSLContext())
-        query = """
-            SELECT * FROM config
-        """
-        self.config = {r['guild_id']: dict(r) for r in await self.pool.fetch(query)}
+        self.configs = ConfigStore(self.pool, interval=settings.get('config_flush_interval', 5),
+                                   maxsize=settings.get('config_cache_size', 10000),
+                                   in_use=lambda guild_id: guild_id in self.states, loop=self.loop)
+        await self.configs.setup()
+        await self.configs.listen()
+        self.configs.start()
+        self.catalog = TrackCatalog(self.pool, interval=settings.get('catalog_flush_interval', 5),
+                                    ttl=settings.get('info_cache_ttl', 1800), loop=self.loop)
+        await self.catalog.setup()
+        self.catalog.start()
+        self.snapshots = QueueSnapshots(self, interval=settings.get('snapshot_interval', 5),
+                                        position_interval=settings.get('snapshot_position_interval', 30),
+                                        restore_delay=settings.get('restore_delay', 1), loop=self.loop)
+        await self.snapshots.setup()
+        self.snapshots.start()
+        self.snapshots.restore_all()
+        port = settings.get('metrics_port')
+        if port and self.metrics_server is None:
+            self.register_gauges()
+            # every worker of a cluster gets its own port
+            self.metrics_server = await metrics.serve(port + (self.worker_id or 0))
         if os.name != 'nt':
             try:
                 discord.opus.load_opus("libopus.so.0.5.3")
             except Exception as e:
                 print(f"Couldnt load opus:\n    {e}\nThe bot might not work.")
 
+    # what close() shuts down, in order; snapshots go first, while still connected, so the positions are current
+    cleanup_steps = (('ipc', 'close'), ('metrics_server', 'close'), ('monitor', 'close'), ('snapshots', 'close'),
+                     ('audio_cache', 'save'), ('extractor', 'close'), ('presence', 'close'), ('configs', 'close'),
+                     ('catalog', 'close'), ('pool', 'close'))
+
     async def close(self):
         print("Cleaning up...")
-        await self.pool.close()
-        await super().close()
+        try:
+            # one failing step, e.g. the database being down, mustn't keep the others from running
+            for name, method in self.cleanup_steps:
+                helper = getattr(self, name, None)
+                if helper is None:
+                    continue
+                try:
+                    result = getattr(helper, method)()
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception as e:
+                    print(f"Couldn't {method} {name}:\n    {e}")
+        finally:
+            await super().close()
+
+
+def main(*, shard_ids=None, shard_count=None, conn=None, worker_id=None):
+    game = discord.Game(name="m!help") if not dev else None
+    bot = MusicBot(command_prefix=list(prefixes), description="Music Bot\n[M] indicates master role only.",
+                   activity=game, shard_ids=shard_ids, shard_count=shard_count)
+    bot.worker_id = worker_id
+    if conn is not None:
+        bot.ipc = ClusterIPC(conn, worker_id=worker_id, loop=bot.loop)
+        bot.ipc.handlers['stats'] = bot.local_stats
+        bot.ipc.start()
+    bot.run(token)
 
 
-game = discord.Game(name="m!help") if not dev else None
-bot = MusicBot(command_prefix=["m!", "M!"], description="Music Bot\n[M] indicates master role only.", activity=game)
-bot.run(token)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import asyncio
+import itertools
+import multiprocessing
+import os
+import time
+from multiprocessing.connection import wait
+
+import discord
+
+import bot
+
+
+def run_worker(worker_id, shard_ids, shard_count, conn):
+    # a forked worker would otherwise share the launcher's loop, its epoll instance and self-pipe
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    bot.main(shard_ids=shard_ids, shard_count=shard_count, conn=conn, worker_id=worker_id)
+
+
+async def recommended_shards(token):
+    http = discord.http.HTTPClient()
+    try:
+        await http.static_login(token, bot=True)
+        data = await http.request(discord.http.Route('GET', '/gateway/bot'))
+        return data['shards']
+    finally:
+        await http.close()
+
+
+class Worker:
+    def __init__(self, worker_id, shard_ids):
+        self.id = worker_id
+        self.shard_ids = shard_ids
+        self.process = None
+        self.conn = None
+        self.started = 0
+        self.last_seen = 0
+        self.failures = 0
+        self.restart_at = 0  # when a dead worker gets started again
+
+
+class Cluster:
+    """Runs the bot as several processes on one machine, each with its own range of shards.
+    Workers send heartbeats over a pipe. Ones that die or stop sending them
+    are restarted with a growing delay. The launcher also relays `gather`
+    requests so a worker can ask every other worker something.
+    """
+    def __init__(self, *, workers, shard_count, heartbeat_timeout=60, identify_delay=5):
+        self.shard_count = shard_count
+        self.heartbeat_timeout = heartbeat_timeout
+        self.identify_delay = identify_delay
+        per_worker = -(-shard_count // workers)  # ceil
+        shards = list(range(shard_count))
+        self.workers = [Worker(i, shards[i * per_worker:(i + 1) * per_worker]) for i in range(workers)]
+        self.workers = [w for w in self.workers if w.shard_ids]
+        self._nonces = itertools.count()
+        self._gathers = {}  # nonce -> (origin worker, origin nonce, replies, deadline)
+
+    def start(self, worker):
+        parent, child = multiprocessing.Pipe()
+        worker.process = multiprocessing.Process(target=run_worker, name=f'shinobot-{worker.id}', daemon=True,
+                                                 args=(worker.id, worker.shard_ids, self.shard_count, child))
+        worker.process.start()
+        child.close()
+        worker.conn = parent
+        worker.started = worker.last_seen = time.monotonic()
+        print(f"Started worker {worker.id} with shards {worker.shard_ids[0]}-{worker.shard_ids[-1]}")
+
+    def stop(self, worker):
+        if worker.process is not None and worker.process.is_alive():
+            worker.process.terminate()
+            worker.process.join(5)
+        if worker.conn is not None:
+            worker.conn.close()
+        worker.process = worker.conn = None
+
+    def check_health(self):
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.process is None:
+                if now >= worker.restart_at:
+                    self.start(worker)
+                continue
+
+            if not worker.process.is_alive():
+                reason = f"exited with {worker.process.exitcode}"
+            elif now - worker.last_seen > self.heartbeat_timeout:
+                reason = f"missed heartbeats for {now - worker.last_seen:.0f}s"
+            else:
+                if now - worker.started > 300:
+                    worker.failures = 0  # it's been fine for a while
+                continue
+
+            self.stop(worker)
+            worker.failures += 1
+            delay = min(60, 5 * 2 ** (worker.failures - 1))
+            worker.restart_at = now + delay
+            print(f"Worker {worker.id} {reason}, restarting in {delay}s")
+
+    def send(self, worker, msg):
+        try:
+            worker.conn.send(msg)
+        except (OSError, AttributeError):
+            pass  # dead, the health check will take care of it
+
+    def handle(self, worker, msg):
+        op = msg['op']
+        if op == 'heartbeat':
+            worker.last_seen = time.monotonic()
+        elif op == 'gather':
+            nonce = next(self._nonces)
+            live = [w for w in self.workers if w.conn is not None]
+            self._gathers[nonce] = (worker, msg['nonce'], {w.id: None for w in live}, time.monotonic() + 3)
+            for w in live:
+                self.send(w, {'op': msg['request'], 'nonce': nonce, 'args': msg['args']})
+        elif op == 'reply':
+            gather = self._gathers.get(msg['nonce'])
+            if gather is not None:
+                gather[2][msg['worker']] = msg['data']
+                if all(r is not None for r in gather[2].values()):
+                    self.finish_gather(msg['nonce'])
+
+    def finish_gather(self, nonce):
+        origin, origin_nonce, replies, _ = self._gathers.pop(nonce)
+        self.send(origin, {'op': 'reply', 'nonce': origin_nonce, 'data': replies})
+
+    def expire_gathers(self):
+        now = time.monotonic()
+        for nonce, (_, _, _, deadline) in list(self._gathers.items()):
+            if now > deadline:
+                self.finish_gather(nonce)  # reply with what we have
+
+    def run(self):
+        # every shard has to identify, and discord only allows one identify every 5 seconds
+        start = time.monotonic()
+        for worker in self.workers:
+            worker.restart_at = start
+            start += self.identify_delay * len(worker.shard_ids)
+
+        while True:
+            conns = {w.conn: w for w in self.workers if w.conn is not None}
+            for conn in wait(list(conns), timeout=1):
+                worker = conns[conn]
+                try:
+                    msg = conn.recv()
+                except (EOFError, OSError):
+                    worker.last_seen = 0  # gone, let the health check restart it
+                    continue
+                self.handle(worker, msg)
+            self.check_health()
+            self.expire_gathers()
+
+
+def main():
+    settings = bot.settings
+    shard_count = settings.get('shard_count')
+    if shard_count is None:
+        loop = asyncio.new_event_loop()
+        try:
+            shard_count = loop.run_until_complete(recommended_shards(bot.token))
+        finally:
+            loop.close()
+    workers = settings.get('cluster_workers') or os.cpu_count() or 1
+    Cluster(workers=min(workers, shard_count), shard_count=shard_count,
+            heartbeat_timeout=settings.get('heartbeat_timeout', 60)).run()
+
+
+if __name__ == '__main__':
+    main()
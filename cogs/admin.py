@@ -0,0 +1,103 @@
+import asyncio
+import io
+import time
+
+import discord
+from discord.ext import commands
+
+from utils import health
+
+
+class Admin:
+    def __init__(self, bot):
+        self.bot = bot
+        self.profiling = False
+
+    @commands.is_owner()
+    @commands.command(hidden=True)
+    async def cluster(self, ctx):
+        """Shows stats for every worker process"""
+        if self.bot.ipc is None:
+            stats = {0: self.bot.local_stats()}
+        else:
+            stats = await self.bot.ipc.gather('stats')
+
+        embed = discord.Embed(title="Cluster")
+        for worker_id, s in sorted(stats.items()):
+            if s is None or 'error' in s:
+                embed.add_field(name=f"Worker {worker_id}", value="No reply", inline=False)
+                continue
+            shards = s['shards']
+            embed.add_field(name=f"Worker {worker_id} (shards {shards[0]}-{shards[-1]})",
+                            value=f"{s['guilds']} guilds, {s['voice']} voice connections, "
+                                  f"{s['states']} voice states, {s['latency'] * 1000:.0f}ms",
+                            inline=False)
+        total = sum(s['guilds'] for s in stats.values() if s and 'error' not in s)
+        embed.set_footer(text=f"{total} guilds in total")
+        await ctx.send(embed=embed)
+
+    @commands.is_owner()
+    @commands.command(hidden=True)
+    async def tasks(self, ctx):
+        """Lists the running asyncio tasks, by the voice state they belong to"""
+        tasks = {t for t in asyncio.Task.all_tasks(loop=self.bot.loop) if not t.done()}
+        lines = []
+        for guild_id, state in self.bot.states.items():
+            owned = []
+            if state.pl_task is not None:
+                owned.append(('playlist', state.pl_task))
+            songs = ([state.current] if state.current is not None else []) + state.queue.peek(state.lookahead)
+            owned.extend((f'prepare #{song.id}', song.task) for song in songs if song.task is not None)
+            owned = [(name, task) for name, task in owned if task in tasks]
+            tasks.difference_update(task for _, task in owned)
+            voice = state.guild.voice_client
+            status = 'idle'
+            if voice is not None and voice.is_paused():
+                status = 'paused'
+            elif voice is not None and voice.is_playing():
+                status = 'playing'
+            lines.append(f"{state.guild} ({guild_id}): {status}, {len(state.queue)} queued, "
+                         f"{len(state.listeners)} listening")
+            lines.extend(f"  {name}: {health.describe_task(task)}" for name, task in owned)
+
+        lines.append(f"Other tasks ({len(tasks)}):")
+        lines.extend(f"  {where}" for where in sorted(health.describe_task(t) for t in tasks))
+        text = '\n'.join(lines)
+        if len(text) < 1900:
+            return await ctx.send(f"```\n{text}\n```")
+        await ctx.send(file=discord.File(io.BytesIO(text.encode()), filename='tasks.txt'))
+
+    @commands.is_owner()
+    @commands.command(hidden=True)
+    async def stalls(self, ctx):
+        """Shows the latest event loop stalls and where they happened"""
+        monitor = self.bot.monitor
+        if monitor is None:
+            return await ctx.send("The loop monitor is off.")
+        if not monitor.stalls:
+            return await ctx.send(f"No stalls over {monitor.threshold}s so far.")
+        text = '\n\n'.join(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(at))} UTC, {lag:.3f}s\n"
+                           f"{stack or 'no stack captured'}" for at, lag, stack in monitor.stalls)
+        await ctx.send(f"{len(monitor.stalls)} latest stalls:",
+                       file=discord.File(io.BytesIO(text.encode()), filename='stalls.txt'))
+
+    @commands.is_owner()
+    @commands.command(hidden=True)
+    async def profile(self, ctx, seconds: float = 10):
+        """Samples what every thread is doing for a while, as folded stacks for a flame graph"""
+        if self.profiling:
+            return await ctx.send("Already profiling.")
+        seconds = min(max(seconds, 1), 60)
+        self.profiling = True
+        try:
+            await ctx.send(f"Profiling for {seconds:g}s...")
+            counts = await health.profile(seconds, loop=self.bot.loop)
+        finally:
+            self.profiling = False
+        data = health.format_profile(counts).encode()
+        await ctx.send(f"{sum(counts.values())} samples of {len(counts)} distinct stacks.",
+                       file=discord.File(io.BytesIO(data), filename='profile.folded'))
+
+
+def setup(bot):
+    bot.add_cog(Admin(bot))
@@ -15,14 +15,7 @@ class Configuration:
         """Sets the master role for the server
         The `role` argument can be an ID, name, or mention of a role.
         """
-        ctx.config['role_id'] = role.id
-        query = """
-            INSERT INTO config (guild_id, role_id)
-            VALUES ($1, $2)
-                ON CONFLICT (guild_id)
-                DO UPDATE SET role_id = EXCLUDED.role_id
-        """
-        await self.bot.pool.execute(query, ctx.guild.id, role.id)
+        await self.bot.configs.set(ctx.guild.id, 'role_id', role.id)
         await ctx.message.add_reaction("\N{OK HAND SIGN}")
 
     @master_only()
@@ -30,7 +23,7 @@ class Configuration:
     async def locked(self, ctx, typ="Embed"):
         """[M] List all locked members"""
 
-        entries = [self.bot.get_user(uid) for uid in ctx.config['locked']]
+        entries = [u for u in map(self.bot.get_user, ctx.config['locked']) if u is not None]
 
         if typ.lower() in ('embed', 'e'):
             p = Pages(self.bot, message=ctx.message, entries=[e.mention for e in entries])
@@ -51,54 +44,38 @@ class Configuration:
 
     @master_only()
     @commands.command()
-    async def lock(self, ctx, user: discord.Member):
-        """[M] Locks a user from using the bot"""
-
-        if ctx.config['locked'] is None:
-            ctx.config['locked'] = [user.id]
-        else:
-            ctx.config['locked'].append(user.id)
+    async def lock(self, ctx, *users: discord.Member):
+        """[M] Locks one or more users from using the bot"""
+        if not users:
+            return await ctx.send("Specify at least one member to lock.")
 
-        query = """
-            UPDATE config
-            SET locked = array_append(locked, $2)
-            WHERE guild_id = $1
-        """
-        await self.bot.pool.execute(query, ctx.guild.id, user.id)
+        await self.bot.configs.lock(ctx.guild.id, *(u.id for u in users))
         await ctx.message.add_reaction("\N{OK HAND SIGN}")
 
     @master_only()
     @commands.command()
-    async def unlock(self, ctx, user: discord.Member):
-        """[M] Unlocks a user from using the bot"""
-
-        if ctx.config['locked'] is None:
+    async def unlock(self, ctx, *users: discord.Member):
+        """[M] Unlocks one or more users from using the bot"""
+        if not ctx.config['locked']:
             return await ctx.send("There are no locked users.")
-        else:
-            ctx.config['locked'].remove(user.id)
+        if not users:
+            return await ctx.send("Specify at least one member to unlock.")
 
-        query = """
-            UPDATE config
-            SET locked = array_remove(locked, $2)
-            WHERE guild_id = $1
-        """
-        await self.bot.pool.execute(query, ctx.guild.id, user.id)
+        if not await self.bot.configs.unlock(ctx.guild.id, *(u.id for u in users)):
+            return await ctx.send("None of those members are locked.")
         await ctx.message.add_reaction("\N{OK HAND SIGN}")
 
     @master_only()
     @commands.command()
     async def config(self, ctx, key, value: int):
         """[M] Set config values"""
-        if key not in ('length_max', 'songs_max'):
-            return await ctx.send("Invalid key! Only `length_max` or `songs_max` can be configured.")
-
-        ctx.config[key] = value
-        query = """
-            UPDATE config
-            SET {} = $2
-            WHERE guild_id = $1
-        """.format(key)
-        await self.bot.pool.execute(query, ctx.guild.id, value)
+        if key not in ('length_max', 'songs_max', 'download', 'resolve_max', 'user_songs_max'):
+            return await ctx.send("Invalid key! Only `length_max`, `songs_max`, `download`, `resolve_max` "
+                                  "or `user_songs_max` can be configured.")
+        if key == 'download':
+            value = bool(value)
+
+        await self.bot.configs.set(ctx.guild.id, key, value)
         await ctx.message.add_reaction("\N{OK HAND SIGN}")
 
 
@@ -1,18 +1,49 @@
-from collections import namedtuple
+import asyncio
+import os
+import time
 
 import discord
 from discord.ext import commands
 
-from utils.resources import YTDLSource, get_song_length
-from utils.paginator import Pages
-
-Song = namedtuple("Song", "ctx player notif")
+from utils import metrics
+from utils.admission import Admission, Busy
+from utils.cache import AudioCache, InfoCache
+from utils.extractor import ExtractionError, ExtractorPool
+from utils.presence import PresenceManager
+from utils.sender import Outbox
+from utils.resources import OpusSource, Song, TrackError, is_listener, resolve, resolve_attachment
+from utils.tracks import QueueFull
+from utils.paginator import PageSource, Pages
+
+
+class QueueSource(PageSource):
+    """Formats only the queue page being shown, optionally just one member's songs."""
+    def __init__(self, queue, requester=None):
+        self.queue = queue
+        self.requester = requester
+
+    @property
+    def version(self):
+        return self.queue.version
+
+    def count(self):
+        if self.requester is not None:
+            return self.queue.count_by(self.requester.id)
+        return len(self.queue)
+
+    def get_page(self, page):
+        base = (page - 1) * self.per_page
+        if self.requester is not None:
+            songs = self.queue.by_requester(self.requester.id)[base:base + self.per_page]
+            return [f"{song.title} `#{song.id}`\n" for song in songs]
+        songs = self.queue.slice(base, base + self.per_page)
+        return [f"{song.title} `#{song.id}`\n    By: {song.requester.name}" for song in songs]
 
 
 def master_only():
     def predicate(ctx):
-        if ctx.state.master:
-            return ctx.state.master in ctx.author.roles
+        if ctx.master:
+            return ctx.master in ctx.author.roles
         return False
     return commands.check(predicate)
 
@@ -21,21 +52,83 @@ class Music:
     def __init__(self, bot):
         self.bot = bot
         self.bot.states = {}
+        self.bot.info_cache = InfoCache(maxsize=bot.settings.get('info_cache_size', 512),
+                                        ttl=bot.settings.get('info_cache_ttl', 1800))
+        cache_dir = bot.settings.get('cache_dir', 'cache')
+        if bot.worker_id is not None:
+            # refcounts and the index live in each process, so cluster workers can't share a directory
+            cache_dir = os.path.join(cache_dir, str(bot.worker_id))
+        self.bot.audio_cache = AudioCache(cache_dir,
+                                          max_bytes=bot.settings.get('cache_max_mb', 1024) * 1024 * 1024,
+                                          loop=bot.loop)
+        self.bot.extractor = ExtractorPool(workers=bot.settings.get('extract_workers', 2),
+                                           timeout=bot.settings.get('extract_timeout', 60),
+                                           download_timeout=bot.settings.get('download_timeout', 600),
+                                           loop=bot.loop)
+        self.bot.presence = PresenceManager(bot, interval=bot.settings.get('presence_interval', 15),
+                                            policy='off' if bot.dev else bot.settings.get('presence', 'recent'),
+                                            idle=discord.Game(name="m!help"))
+        self.bot.presence.start()
+        self.bot.outbox = Outbox(loop=bot.loop)
+        self.bot.admission = Admission(limit=bot.settings.get('resolve_global_max', 8),
+                                       waiting=bot.settings.get('resolve_wait_max', 32), loop=bot.loop)
+        self.sweeper = bot.loop.create_task(self.sweep_states())
+
+    def __unload(self):
+        self.sweeper.cancel()
+
+    async def sweep_states(self):
+        """Leaves voice and forgets the state of guilds that have been idle for `idle_timeout` seconds.
+        With the `disconnect` empty policy, guilds nobody has listened in for `empty_timeout` seconds are left too,
+        with `resume` they stay paused until someone comes back.
+        """
+        timeout = self.bot.settings.get('idle_timeout', 300)
+        leave_empty = self.bot.settings.get('empty_policy', 'disconnect') == 'disconnect'
+        empty_timeout = self.bot.settings.get('empty_timeout', 60)
+        while True:
+            await asyncio.sleep(min(timeout, empty_timeout, 60))
+            now = time.monotonic()
+            for guild_id, state in list(self.bot.states.items()):
+                gone = self.bot.get_guild(guild_id) is None
+                idle = state.idle and now - state.idle_since >= timeout
+                empty = leave_empty and state.empty_since is not None and now - state.empty_since >= empty_timeout
+                if not (gone or idle or empty):
+                    continue
+                del self.bot.states[guild_id]
+                state.close()
+                voice = state.guild.voice_client
+                if voice is not None:
+                    try:
+                        await voice.disconnect()
+                    except Exception as e:
+                        print(f"Couldn't leave voice in {state.guild}:\n    {e}")
+
+    async def on_voice_state_update(self, member, before, after):
+        state = self.bot.states.get(member.guild.id)
+        if state is None:
+            return
+        if member.id == self.bot.user.id:
+            state.recount(after.channel)  # we joined, moved or left
+            return
+        me = member.guild.me.voice
+        channel = me.channel if me is not None else None
+        if channel is None or channel not in (before.channel, after.channel):
+            return
+        state.update_listener(member, after.channel == channel and is_listener(member, after))
 
     def __local_check(self, ctx):
-        if ctx.config['locked'] is None:
-            return True
         return ctx.author.id not in ctx.config['locked']
 
     @master_only()
     @commands.command()
     async def summon(self, ctx):
         """[M] Joins the channel you're currently in"""
-        if ctx.author.voice:
-            if ctx.voice_client:
-                return await ctx.voice_client.move_to(ctx.author.voice.channel)
-            return await ctx.author.voice.channel.connect()
-        await ctx.send(":exclamation: You're not connected to a voice channel!")
+        if not ctx.author.voice:
+            return await ctx.send(":exclamation: You're not connected to a voice channel!")
+        if ctx.voice_client:
+            return await ctx.voice_client.move_to(ctx.author.voice.channel)
+        await ctx.author.voice.channel.connect()
+        ctx.state.touch()  # left again if nothing gets queued
 
     @master_only()
     @commands.command()
@@ -44,49 +137,157 @@ class Music:
         if ctx.voice_client is not None:
             return await ctx.voice_client.move_to(channel)
         await channel.connect()
+        ctx.state.touch()  # left again if nothing gets queued
 
-    @commands.command()
-    async def play(self, ctx, *, query=None):
-        """Streams from a query (almost anything youtube_dl supports)"""
+    async def join_author(self, ctx):
+        """Connects to the author's channel if needed, returns whether they can queue songs."""
         if ctx.voice_client is None:
             if ctx.author.voice:
                 await ctx.author.voice.channel.connect()
             else:
-                return await ctx.send(":exclamation: Not connected to a voice channel.")
+                await ctx.send(":exclamation: Not connected to a voice channel.")
+                return False
 
         if ctx.author.voice:
             if ctx.author.voice.channel != ctx.voice_client.channel:
-                return await ctx.send(":exclamation: You must be in the same channel as me!")
+                await ctx.send(":exclamation: You must be in the same channel as me!")
+                return False
         else:
-            return await ctx.send("You must be in the voice channel to queue songs!")
+            await ctx.send("You must be in the voice channel to queue songs!")
+            return False
+        return True
+
+    def user_limit(self, ctx):
+        """Returns the author's pending song limit if they've reached it, None otherwise."""
+        limit = ctx.config['user_songs_max']
+        if limit is None:
+            limit = self.bot.settings.get('user_songs_max')
+        if limit and limit > 0 and ctx.state.queue.count_by(ctx.author.id) >= limit:
+            return limit
+        return None
+
+    async def admit(self, ctx):
+        """Returns a ticket to resolve something for the guild, or None if we're too busy to even wait."""
+        guild_limit = ctx.config['resolve_max']
+        if guild_limit is None:
+            guild_limit = self.bot.settings.get('resolve_max', 2)
+        try:
+            ticket = self.bot.admission.enter(ctx.guild.id, guild_limit=guild_limit)
+        except Busy:
+            metrics.resolves_refused.inc()
+            await ctx.send("I'm too busy right now, try again in a bit.")
+            return None
+        if ticket.position:
+            self.bot.outbox.post(ctx.channel, f"Busy, position {ticket.position} in line.")
+        return ticket
 
-        async with ctx.typing():
+    @commands.command()
+    async def play(self, ctx, *, query=None):
+        """Streams from a query (almost anything youtube_dl supports)"""
+        if not await self.join_author(ctx):
+            return
+        if not query and not ctx.message.attachments:
+            return await ctx.send("Must specify search query or upload music file.")
+        limit = self.user_limit(ctx)
+        if limit:
+            return await ctx.send(f"You already have `{limit}` songs queued! Wait for some of them to play.")
+
+        ticket = await self.admit(ctx)
+        if ticket is None:
+            return
+        async with ticket, ctx.typing():
             if query:
+                try:
+                    # a known song can be checked and queued from the catalog, it's resolved before it plays
+                    data = await resolve(query, pool=self.bot.extractor, guild_id=ctx.guild.id,
+                                         cache=self.bot.info_cache, catalog=self.bot.catalog, stream=False)
+                except ExtractionError as e:
+                    return await ctx.send(f"Could not find that song: {e}")
                 max_len = ctx.config['length_max']
                 if max_len and max_len > 0:
-                    length = await get_song_length(query)
-                    if length > max_len:
+                    if data.get('duration') and data['duration'] > max_len:
                         return await ctx.send(f"Song is too long! Limit is `{max_len}` seconds.")
-                player = await YTDLSource.from_query(query, loop=self.bot.loop)
-            elif len(ctx.message.attachments) > 0:
-                try:
-                    file = ctx.message.attachments[0]
-                    await file.save(file.filename)
-                    player = YTDLSource.from_file(file.filename)
-                except Exception as e:
-                    print(e)
-                    return await ctx.send("Could not play file.")
+                song = Song(data, requester=ctx.author, channel=ctx.channel)
             else:
-                return await ctx.send("Must specify search query or upload music file.")
-        song = Song(ctx, player, [])
-        await ctx.state.queue.put(song)
-        await ctx.send(f'Enqueued:\n     {player.title}')
+                max_bytes = self.bot.settings.get('upload_max_mb', 25) * 1024 * 1024
+                try:
+                    # probed straight from discord, long files are refused before anything is downloaded
+                    data = await resolve_attachment(ctx.message.attachments[0], max_bytes=max_bytes,
+                                                    max_length=ctx.config['length_max'])
+                except TrackError as e:
+                    return await ctx.send(f"Could not play file: {e}")
+                song = Song(data, requester=ctx.author, channel=ctx.channel)
+        limit = self.user_limit(ctx)  # other songs of theirs might have been queued in the meantime
+        if limit:
+            return await ctx.send(f"You already have `{limit}` songs queued! Wait for some of them to play.")
+        try:
+            ctx.state.queue.put(song, maxsize=ctx.config['songs_max'])
+        except QueueFull as e:
+            song.cleanup()
+            return await ctx.send(f"The queue is full! Limit is `{e}` songs.")
+        ctx.state.prefetch()
+        ctx.state.start()
+        self.bot.outbox.enqueued(ctx.channel, song.title)
+
+    @commands.command(aliases=['pl'])
+    async def playlist(self, ctx, *, url):
+        """Queues every song of a playlist"""
+        if not await self.join_author(ctx):
+            return
+        limit = self.user_limit(ctx)
+        if limit:
+            return await ctx.send(f"You already have `{limit}` songs queued! Wait for some of them to play.")
+
+        ticket = await self.admit(ctx)
+        if ticket is None:
+            return
+        async with ticket, ctx.typing():
+            try:
+                # only titles and ids are fetched, songs are resolved once they get close to playing
+                data = await self.bot.extractor.playlist(url, limit=self.bot.settings.get('playlist_max', 100),
+                                                         guild_id=ctx.guild.id)
+            except ExtractionError as e:
+                return await ctx.send(f"Could not load that playlist: {e}")
+
+        max_len = ctx.config['length_max']
+        if max_len and max_len > 0:
+            # flat listings often leave out durations, songs that were played before fill them in
+            unknown = [e['webpage_url'] for e in data['entries'] if e['duration'] is None]
+            known = await self.bot.catalog.get_many(unknown) if unknown else {}
+            for entry in data['entries']:
+                if entry['webpage_url'] in known:
+                    entry['duration'] = known[entry['webpage_url']]['duration']
+
+        added = skipped = 0
+        for entry in data['entries']:
+            if max_len and max_len > 0 and (entry['duration'] or 0) > max_len:
+                skipped += 1
+                continue
+            try:
+                ctx.state.queue.put(Song(entry, requester=ctx.author, channel=ctx.channel),
+                                    maxsize=ctx.config['songs_max'])
+            except QueueFull:
+                skipped += len(data['entries']) - added - skipped
+                break
+            added += 1
+            if self.user_limit(ctx):
+                skipped += len(data['entries']) - added - skipped
+                break
+        ctx.state.prefetch()
+        ctx.state.start()
+
+        fmt = f"Enqueued {added} songs from `{data['title'] or url}`."
+        if skipped:
+            fmt += f" Skipped {skipped} that were too long or over the queue limits."
+        self.bot.outbox.post(ctx.channel, fmt)
 
     @commands.command(aliases=["np"])
     async def playing(self, ctx):
         """Shows the currently playing song"""
         song = ctx.state.current
-        embed = discord.Embed(title=song.ctx.author.name, description=song.player.title)
+        if song is None:
+            return await ctx.send("Nothing is playing right now.")
+        embed = discord.Embed(title=song.requester.name, description=song.title)
         await ctx.send(embed=embed)
 
     @commands.command()
@@ -100,12 +301,14 @@ class Music:
                 return await ctx.send("You must be in the same channel as me to skip!")
         else:
             return await ctx.send("You're not in the voice channel!")
+        if not is_listener(ctx.author):
+            return await ctx.send("You can't vote while deafened!")
 
         if ctx.author.id in ctx.state.skips:
             await ctx.send("You've voted already!")
         else:
-            ctx.state.skips.append(ctx.author.id)
-            await ctx.send("Added vote to skip the song")
+            ctx.state.skips.add(ctx.author.id)
+            self.bot.outbox.post(ctx.channel, "Added vote to skip the song")
             ctx.state.skip_song()
 
     @commands.command()
@@ -114,8 +317,7 @@ class Music:
         q = ctx.state.queue
         if q.empty():
             return await ctx.send("The queue is currently empty.\nYou can queue songs by typing `m!play <song name>`.")
-        queue = [f"{song.player.title}\n    By: {song.ctx.author.name}" for song in q._queue]
-        p = Pages(self.bot, message=ctx.message, entries=queue)
+        p = Pages(self.bot, message=ctx.message, source=QueueSource(q))
         p.embed.set_author(name="Music Queue")
         await p.paginate()
 
@@ -123,11 +325,10 @@ class Music:
     async def myqueue(self, ctx):
         """Shows the songs you've queued"""
         q = ctx.state.queue
-        queue = [f"{song.player.title}\n" for song in q._queue if song.ctx.author == ctx.author]
-        if not queue:
+        if not q.count_by(ctx.author.id):
             return await ctx.send("You haven't queued anything yet! "
                                   "You can queue songs by typing `m!play <song name>`.")
-        p = Pages(self.bot, message=ctx.message, entries=queue)
+        p = Pages(self.bot, message=ctx.message, source=QueueSource(q, ctx.author))
         p.embed.set_author(name=f"{ctx.author.name}'s Queue", icon_url=ctx.author.avatar_url)
         await p.paginate()
 
@@ -135,51 +336,63 @@ class Music:
     async def unqueue(self, ctx):
         """Unqueue the last song you've queued"""
         q = ctx.state.queue
-        if sum(1 for s in q._queue if s.ctx.author == ctx.author) == 0:
+        target = q.last_by(ctx.author.id)
+        if target is None:
             return await ctx.send("You don't have any songs queued. Use `m!play <song name>` to queue something.")
 
-        target = None
-        for s in reversed(q._queue):
-            if s.ctx.author == ctx.author:
-                target = s
-                break
-        q._queue.remove(target)
+        q.remove(target)
+        target.cleanup()
+        ctx.state.prefetch()
 
-        await ctx.send(f"Removed `{s.player.title}` from the queue.")
+        self.bot.outbox.post(ctx.channel, f"Removed `{target.title}` from the queue.")
 
-    @commands.command()
-    async def remove(self, ctx, n: int):
-        """Remove a specific song from the queue"""
-        queue = ctx.state.queue._queue
+    async def find_song(self, ctx, ref):
+        """Looks up a song by its queue number, or by its id as `#id`."""
+        q = ctx.state.queue
+        if ref.startswith('#') and ref[1:].isdigit():
+            s = q.find(int(ref[1:]))
+            if s is None:
+                await ctx.send("No song with that id is queued. Check the queue for valid ids.")
+            return s
 
         try:
-            s = queue[n - 1]
-        except IndexError:
-            if n < 1:
-                return await ctx.send("Song number cannot be negative or zero.")
+            n = int(ref)
+        except ValueError:
+            await ctx.send("Specify a song number, or a song id like `#12`.")
+            return None
+        if n < 1:
+            await ctx.send("Song number cannot be negative or zero.")
+            return None
+        s = q.at(n)
+        if s is None:
             await ctx.send("Invalid song number. Check the queue for valid numbers.")
+        return s
 
-        if ctx.state.master and s.ctx.author != ctx.author:
-            if ctx.state.master not in ctx.author.roles:
+    @commands.command()
+    async def remove(self, ctx, song):
+        """Remove a specific song from the queue, by number or `#id`"""
+        s = await self.find_song(ctx, song)
+        if s is None:
+            return
+
+        if ctx.master and s.requester != ctx.author:
+            if ctx.master not in ctx.author.roles:
                 return await ctx.send("You can only remove songs queued by yourself.")
 
-        queue.remove(s)
-        await ctx.send(f"Removed `{s.player.title}` from the queue.")
+        ctx.state.queue.remove(s)
+        s.cleanup()
+        ctx.state.prefetch()
+        self.bot.outbox.post(ctx.channel, f"Removed `{s.title}` from the queue.")
 
     @commands.command()
-    async def notify(self, ctx, n: int):
-        """Pings you when specified song comes on"""
-        queue = ctx.state.queue._queue
-
-        try:
-            s = queue[n - 1]
-        except IndexError:
-            if n < 1:
-                return await ctx.send("Song number cannot be negative or zero.")
-            await ctx.send("Invalid song number. Check the queue for valid numbers.")
+    async def notify(self, ctx, song):
+        """Pings you when specified song comes on, by number or `#id`"""
+        s = await self.find_song(ctx, song)
+        if s is None:
+            return
 
         s.notif.append(ctx.author.id)
-        await ctx.send(f"Added you to `{s.player.title}`.")
+        await ctx.send(f"Added you to `{s.title}`.")
 
     @master_only()
     @commands.command()
@@ -189,7 +402,22 @@ class Music:
         if ctx.voice_client is None:
             return await ctx.send("Not connected to a voice channel.")
 
-        ctx.voice_client.source.volume = volume / 100
+        state = ctx.state
+        state.volume = volume / 100
+        source = ctx.voice_client.source
+        if isinstance(source, OpusSource):
+            # ffmpeg applies the volume, so pick the song up again at the new one
+            new = source.restart(volume=state.volume)
+            await new.warm(loop=self.bot.loop)
+            if ctx.voice_client is None or ctx.voice_client.source is not source:
+                new.cleanup()  # the song ended in the meantime
+            else:
+                new.take_over(source)
+                ctx.voice_client.source = new
+                state.current.player = new
+                source.cleanup()
+        elif source is not None:
+            source.volume = state.volume
         await ctx.send(f"Changed volume to {volume}%")
 
     @master_only()
@@ -197,10 +425,10 @@ class Music:
     async def stop(self, ctx):
         """[M] Stops and disconnects the bot from voice"""
         state = ctx.state
+        self.bot.extractor.cancel_guild(ctx.guild.id)
         async with ctx.typing():
-            if not state.queue.empty():
-                for _ in range(state.queue.qsize()):
-                    state.queue.get_nowait()
+            for song in state.queue.clear():
+                song.cleanup()
 
         await ctx.send("<:blobstop:340118614848045076>")
         await ctx.voice_client.disconnect()
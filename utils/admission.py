@@ -0,0 +1,101 @@
+import asyncio
+from collections import Counter, deque
+
+
+class Busy(Exception):
+    pass
+
+
+class Ticket:
+    """A place in line for one resolve, used as `async with` around the work."""
+    __slots__ = ('admission', 'guild_id', 'guild_limit', 'position', 'future')
+
+    def __init__(self, admission, guild_id, guild_limit, position, future=None):
+        self.admission = admission
+        self.guild_id = guild_id
+        self.guild_limit = guild_limit
+        self.position = position  # 0 when it could start right away
+        self.future = future
+
+    async def __aenter__(self):
+        if self.future is None:
+            return self
+        try:
+            await self.future
+        except asyncio.CancelledError:
+            if self.future.done() and not self.future.cancelled():
+                self.admission._release(self.guild_id)  # let in just as we were cancelled
+            else:
+                self.admission._forget(self)
+            raise
+        return self
+
+    async def __aexit__(self, *exc):
+        self.admission._release(self.guild_id)
+
+
+class Admission:
+    """Caps the resolves in flight, `limit` at once overall and a guild's own limit per guild.
+    Requests over the caps wait in line in the order they came, unless `waiting`
+    requests are already waiting, or the guild already has as many waiting as
+    it may run; those are refused with Busy right away instead of piling up.
+    """
+    def __init__(self, *, limit=8, waiting=32, loop=None):
+        self.limit = limit
+        self.waiting = waiting
+        self.loop = loop or asyncio.get_event_loop()
+        self._active = 0
+        self._guild_active = Counter()
+        self._guild_waiting = Counter()
+        self._waiters = deque()  # tickets, in arrival order
+
+    @property
+    def active(self):
+        return self._active
+
+    @property
+    def backlog(self):
+        return len(self._waiters)
+
+    def _can_start(self, guild_id, guild_limit):
+        return self._active < self.limit and (not guild_limit or self._guild_active[guild_id] < guild_limit)
+
+    def _admit(self, guild_id):
+        self._active += 1
+        self._guild_active[guild_id] += 1
+
+    def enter(self, guild_id, *, guild_limit=None):
+        """Returns a ticket for one resolve, raising Busy if there's no room to wait either."""
+        if self._can_start(guild_id, guild_limit):
+            self._admit(guild_id)
+            return Ticket(self, guild_id, guild_limit, 0)
+        if len(self._waiters) >= self.waiting or (guild_limit and self._guild_waiting[guild_id] >= guild_limit):
+            raise Busy()
+        ticket = Ticket(self, guild_id, guild_limit, len(self._waiters) + 1, self.loop.create_future())
+        self._waiters.append(ticket)
+        self._guild_waiting[guild_id] += 1
+        return ticket
+
+    def _remove(self, ticket):
+        self._waiters.remove(ticket)
+        self._guild_waiting[ticket.guild_id] -= 1
+        if not self._guild_waiting[ticket.guild_id]:
+            del self._guild_waiting[ticket.guild_id]
+
+    def _forget(self, ticket):
+        if ticket in self._waiters:
+            self._remove(ticket)
+
+    def _release(self, guild_id):
+        self._active -= 1
+        self._guild_active[guild_id] -= 1
+        if not self._guild_active[guild_id]:
+            del self._guild_active[guild_id]
+        # the first waiters whose guild has room go next, a busy guild doesn't hold up the others
+        for ticket in list(self._waiters):
+            if self._active >= self.limit:
+                break
+            if self._can_start(ticket.guild_id, ticket.guild_limit):
+                self._remove(ticket)
+                self._admit(ticket.guild_id)
+                ticket.future.set_result(None)
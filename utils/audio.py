@@ -0,0 +1,96 @@
+import itertools
+import shlex
+import struct
+import subprocess
+
+import discord
+
+
+class OggStream:
+    """Splits an ogg stream into the packets it carries."""
+    def __init__(self, stream):
+        self.stream = stream
+
+    def _read_page(self):
+        header = self.stream.read(27)
+        if len(header) < 27 or header[:4] != b'OggS':
+            return None
+        segments, = struct.unpack_from('<B', header, 26)
+        table = self.stream.read(segments)
+        body = self.stream.read(sum(table))
+        return table, body
+
+    def iter_packets(self):
+        partial = b''
+        while True:
+            page = self._read_page()
+            if page is None:
+                return
+            table, body = page
+            offset = 0
+            for size in table:
+                partial += body[offset:offset + size]
+                offset += size
+                if size < 255:  # a full 255 byte segment means the packet continues
+                    yield partial
+                    partial = b''
+
+
+class FFmpegOpusAudio(discord.AudioSource):
+    """An audio source that has ffmpeg produce opus packets directly.
+    Nothing is decoded or encoded in our process, the packets are sent as they are.
+    Volume is applied by ffmpeg, so changing it means restarting the source.
+    `copy` skips re-encoding entirely when the input is already opus.
+    """
+    def __init__(self, source, *, volume=1.0, copy=False, start=0, before_options=None, options=None):
+        self.source = source
+        self.volume = volume
+        self.start = start
+        self.before_options = before_options
+        self.options = options
+        self.packets = 0
+
+        args = ['ffmpeg']
+        if before_options:
+            args.extend(shlex.split(before_options))
+        if start:
+            args.extend(('-ss', str(start)))
+        args.extend(('-i', source, '-map_metadata', '-1'))
+        if options:
+            args.extend(shlex.split(options))
+        if copy:
+            args.extend(('-c:a', 'copy'))
+        else:
+            args.extend(('-c:a', 'libopus', '-b:a', '128k', '-ar', '48000', '-ac', '2',
+                         '-af', 'volume={}'.format(volume)))
+        args.extend(('-f', 'opus', '-loglevel', 'warning', 'pipe:1'))
+
+        try:
+            self._process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        except FileNotFoundError:
+            raise discord.ClientException('ffmpeg was not found.') from None
+        # the first two packets are the OpusHead and OpusTags headers
+        self._packets = itertools.islice(OggStream(self._process.stdout).iter_packets(), 2, None)
+
+    @property
+    def position(self):
+        """Seconds into the input, each packet is 20ms of audio."""
+        return self.start + self.packets * 0.02
+
+    def read(self):
+        packet = next(self._packets, b'')
+        if packet:
+            self.packets += 1
+        return packet
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        proc = self._process
+        if proc is None:
+            return
+        proc.kill()
+        if proc.poll() is None:
+            proc.communicate()
+        self._process = None
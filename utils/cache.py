@@ -0,0 +1,151 @@
+import json
+import os
+import re
+import time
+from collections import Counter, OrderedDict
+
+_whitespace = re.compile(r'\s+')
+_expire = re.compile(r'[?&/]expire[=/](\d+)')
+
+
+def normalize_query(query):
+    query = query.strip()
+    if query.startswith(('http://', 'https://')):
+        return query
+    return _whitespace.sub(' ', query).lower()
+
+
+def stream_expiry(data, ttl):
+    """When the media url of resolved info should stop being used."""
+    expiry = time.time() + ttl
+    match = _expire.search(data.get('url') or '')
+    if match:
+        # leave a minute of slack so ffmpeg doesn't open a url that's about to die
+        expiry = min(expiry, int(match.group(1)) - 60)
+    return expiry
+
+
+class InfoCache:
+    """Bounded LRU cache of resolved track info, shared by every guild.
+    Entries expire after `ttl` seconds, or earlier if the media url
+    carries its own expiry, so stale stream urls are never handed out.
+    """
+    def __init__(self, *, maxsize=512, ttl=1800):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, query):
+        key = normalize_query(query)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expiry, data = entry
+        if expiry < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return data
+
+    def put(self, query, data):
+        entry = (stream_expiry(data, self.ttl), data)
+        keys = {normalize_query(query)}
+        if data.get('webpage_url'):
+            keys.add(normalize_query(data['webpage_url']))
+        for key in keys:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+class AudioCache:
+    """On-disk cache of downloaded songs shared by every guild, keyed by extractor and id.
+    Files are reference counted while queued or playing and are never evicted
+    while in use. Unused files are evicted least recently used first once the
+    directory grows past `max_bytes`. The index lives in the cache directory
+    so it survives restarts.
+    """
+    def __init__(self, directory='cache', *, max_bytes=1024 * 1024 * 1024, loop=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.loop = loop
+        self.template = os.path.join(directory, '%(extractor_key)s-%(id)s.%(ext)s')
+        self.index_path = os.path.join(directory, 'index.json')
+        self._entries = OrderedDict()  # key -> {'filename': ..., 'size': ...}, least recently used first
+        self._refs = Counter()
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    @staticmethod
+    def key_for(data):
+        return '{}-{}'.format(data.get('extractor_key') or data.get('extractor'), data['id'])
+
+    @property
+    def total(self):
+        return sum(e['size'] for e in self._entries.values())
+
+    def load(self):
+        try:
+            with open(self.index_path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = []
+        for key, entry in entries:
+            if os.path.exists(entry['filename']):
+                self._entries[key] = entry
+
+    def save(self):
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(list(self._entries.items()), f)
+        os.replace(tmp, self.index_path)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if not os.path.exists(entry['filename']):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry['filename']
+
+    def add(self, key, filename):
+        self._entries[key] = {'filename': filename, 'size': os.path.getsize(filename)}
+        self._entries.move_to_end(key)
+        self.evict()
+        self.save()
+
+    def acquire(self, key):
+        self._refs[key] += 1
+
+    def release(self, key):
+        self._refs[key] -= 1
+        if self._refs[key] <= 0:
+            del self._refs[key]
+            self.evict()
+
+    def release_threadsafe(self, key):
+        # audio sources are cleaned up from the voice player thread
+        self.loop.call_soon_threadsafe(self.release, key)
+
+    def evict(self):
+        total = self.total
+        if total <= self.max_bytes:
+            return
+        for key in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            if self._refs[key] > 0:
+                continue
+            entry = self._entries.pop(key)
+            total -= entry['size']
+            try:
+                os.remove(entry['filename'])
+            except OSError:
+                pass
+        self.save()
@@ -0,0 +1,175 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from utils.cache import AudioCache, normalize_query, stream_expiry
+from utils.writebehind import WriteBehind
+
+schema = """
+    CREATE TABLE IF NOT EXISTS tracks (
+        key TEXT PRIMARY KEY,
+        extractor TEXT,
+        extractor_key TEXT,
+        id TEXT NOT NULL,
+        title TEXT,
+        duration DOUBLE PRECISION,
+        webpage_url TEXT,
+        ext TEXT,
+        acodec TEXT,
+        abr DOUBLE PRECISION,
+        resolved_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE TABLE IF NOT EXISTS track_queries (
+        query TEXT PRIMARY KEY,
+        track TEXT NOT NULL REFERENCES tracks (key) ON DELETE CASCADE
+    );
+    CREATE TABLE IF NOT EXISTS track_streams (
+        track TEXT PRIMARY KEY REFERENCES tracks (key) ON DELETE CASCADE,
+        url TEXT NOT NULL,
+        protocol TEXT,
+        http_headers TEXT,
+        expires_at TIMESTAMPTZ NOT NULL
+    );
+"""
+
+# the durable part of resolved info, stream urls go in track_streams
+track_columns = ('extractor', 'extractor_key', 'id', 'title', 'duration', 'webpage_url', 'ext', 'acodec', 'abr')
+
+track_upsert = """
+    INSERT INTO tracks (key, {0}, resolved_at)
+    VALUES ($1, {1}, now())
+        ON CONFLICT (key)
+        DO UPDATE SET {2}, resolved_at = now()
+""".format(', '.join(track_columns),
+           ', '.join(f'${i}' for i in range(2, len(track_columns) + 2)),
+           ', '.join(f'{c} = EXCLUDED.{c}' for c in track_columns))
+
+query_upsert = """
+    INSERT INTO track_queries (query, track)
+    VALUES ($1, $2)
+        ON CONFLICT (query)
+        DO UPDATE SET track = EXCLUDED.track
+"""
+
+stream_upsert = """
+    INSERT INTO track_streams (track, url, protocol, http_headers, expires_at)
+    VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (track)
+        DO UPDATE SET url = EXCLUDED.url, protocol = EXCLUDED.protocol,
+                      http_headers = EXCLUDED.http_headers, expires_at = EXCLUDED.expires_at
+"""
+
+lookup_query = """
+    SELECT q.query, t.*, s.url, s.protocol, s.http_headers, s.expires_at > now() AS fresh
+    FROM track_queries q
+    JOIN tracks t ON t.key = q.track
+    LEFT JOIN track_streams s ON s.track = t.key
+    WHERE q.query = ANY($1::text[])
+"""
+
+
+class TrackCatalog(WriteBehind):
+    """Resolved track info kept in Postgres, so it survives restarts and is shared between processes.
+    Normalized queries and webpage urls point at one row per track. Media urls
+    expire, so they're stored apart from the track with their own expiry;
+    a track whose url has expired still answers titles and length checks.
+    New tracks are written behind in batches every `interval` seconds.
+    """
+    flush_error = "Couldn't write tracks"
+
+    def __init__(self, pool, *, interval=5, ttl=1800, loop=None):
+        self.pool = pool
+        self.interval = interval
+        self.ttl = ttl
+        self.loop = loop or asyncio.get_event_loop()
+        self._pending = OrderedDict()  # track key -> (data, queries, stream expiry)
+        self._queries = {}  # normalized query -> track key, for tracks not written yet
+
+    async def setup(self):
+        await self.pool.execute(schema)
+
+    def _from_record(self, record):
+        data = {c: record[c] for c in track_columns}
+        if record['url'] is not None and record['fresh']:
+            data['url'] = record['url']
+            data['protocol'] = record['protocol']
+            if record['http_headers']:
+                data['http_headers'] = json.loads(record['http_headers'])
+        return data
+
+    def _from_pending(self, key):
+        data, _, expiry = self._pending[key]
+        data = dict(data)
+        if expiry < time.time():
+            data.pop('url', None)
+        return data
+
+    async def get_many(self, queries):
+        """Looks up several queries at once, returns the info of the ones that are known by query.
+        Info without a `url` is still good for its title and duration, but has to be resolved to be played.
+        """
+        found = {}
+        missing = {}
+        for query in queries:
+            normalized = normalize_query(query)
+            key = self._queries.get(normalized)
+            if key is not None:
+                found[query] = self._from_pending(key)
+            else:
+                missing.setdefault(normalized, []).append(query)
+        if missing:
+            try:
+                records = await self.pool.fetch(lookup_query, list(missing))
+            except Exception as e:
+                # the catalog only saves work, songs can still be resolved without it
+                print(f"Couldn't look up tracks:\n    {e}")
+                records = ()
+            for record in records:
+                data = self._from_record(record)
+                for query in missing.get(record['query'], ()):
+                    found[query] = dict(data)
+        return found
+
+    async def get(self, query):
+        return (await self.get_many([query])).get(query)
+
+    def put(self, query, data):
+        """Remembers freshly resolved info under `query` and its webpage url."""
+        key = AudioCache.key_for(data)
+        queries = {normalize_query(query)}
+        if data.get('webpage_url'):
+            queries.add(normalize_query(data['webpage_url']))
+        pending = self._pending.pop(key, None)
+        if pending is not None:
+            queries |= pending[1]
+        self._pending[key] = (data, queries, stream_expiry(data, self.ttl))
+        for q in queries:
+            self._queries[q] = key
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending = list(self._pending.items())
+        tracks, queries, streams = [], [], []
+        for key, (data, qs, expiry) in pending:
+            tracks.append((key, *(data.get(c) for c in track_columns)))
+            queries.extend((q, key) for q in qs)
+            if data.get('url'):
+                streams.append((key, data['url'], data.get('protocol'), json.dumps(data.get('http_headers') or {}),
+                                datetime.fromtimestamp(expiry, timezone.utc)))
+        async with self.pool.acquire() as con:
+            async with con.transaction():
+                await con.executemany(track_upsert, tracks)
+                await con.executemany(query_upsert, queries)
+                if streams:
+                    await con.executemany(stream_upsert, streams)
+
+        # written, unless it failed above; those stay pending and are tried again next time
+        for key, entry in pending:
+            if self._pending.get(key) is entry:  # unless it was resolved again in the meantime
+                del self._pending[key]
+                for q in entry[1]:
+                    if self._queries.get(q) == key:
+                        del self._queries[q]
@@ -0,0 +1,289 @@
+import asyncio
+import json
+import os
+import sys
+from collections import Counter, deque
+
+from utils.cache import normalize_query
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ytdl_format_options = {
+    'format': 'bestaudio/best',
+    'outtmpl': '%(title)s.%(ext)s',
+    'restrictfilenames': True,
+    'noplaylist': True,
+    'nocheckcertificate': True,
+    'ignoreerrors': False,
+    'logtostderr': False,
+    'quiet': True,
+    'no_warnings': True,
+    'default_search': 'ytsearch',
+    'source_address': '0.0.0.0'  # ipv6 addresses cause issues sometimes
+}
+
+# the only fields that are sent back to the bot process
+compact_keys = ('id', 'extractor', 'extractor_key', 'title', 'duration', 'url', 'webpage_url',
+                'ext', 'acodec', 'abr', 'protocol', 'http_headers')
+
+
+class ExtractionError(Exception):
+    pass
+
+
+class Job:
+    __slots__ = ('guild_id', 'key', 'payload', 'timeout', 'future', 'waiters', 'worker')
+
+    def __init__(self, guild_id, key, payload, timeout, future):
+        self.guild_id = guild_id
+        self.key = key
+        self.payload = payload
+        self.timeout = timeout
+        self.future = future
+        self.waiters = Counter()  # guild_id -> requests waiting on the job
+        self.worker = None
+
+
+class Worker:
+    """A single extractor process with its own YoutubeDL instance.
+    Jobs and results are exchanged as json lines over its stdin and stdout.
+    """
+    def __init__(self):
+        self.process = None
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'utils.extractor', cwd=ROOT,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, limit=2 ** 20)
+
+    def kill(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+        self.process = None
+
+    async def run(self, payload, timeout):
+        if self.process is None:
+            await self.start()
+        try:
+            self.process.stdin.write(json.dumps(payload).encode() + b'\n')
+            line = await asyncio.wait_for(self.process.stdout.readline(), timeout)
+        except asyncio.TimeoutError:
+            self.kill()
+            raise ExtractionError('Extraction timed out.')
+        except (OSError, asyncio.CancelledError):
+            self.kill()
+            raise
+        if not line:
+            self.kill()
+            raise ExtractionError('Extractor process died.')
+
+        reply = json.loads(line.decode())
+        if not reply['ok']:
+            raise ExtractionError(reply['error'])
+        return reply['result']
+
+
+class ExtractorPool:
+    """Runs extractions and downloads on a pool of worker processes.
+    Guilds with waiting jobs are served round robin so one busy guild can't
+    starve the others. Identical jobs are merged, and a job is cancelled
+    (killing its worker if it's already running) once nobody waits on it.
+    """
+    def __init__(self, *, workers=2, timeout=60, download_timeout=600, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.timeout = timeout
+        self.download_timeout = download_timeout
+        self.workers = [Worker() for _ in range(workers)]
+        self._queues = {}  # guild_id -> deque of waiting jobs
+        self._order = deque()  # guilds with waiting jobs, in the order they get served
+        self._jobs = {}  # key -> job, for merging identical requests
+        self._idle = asyncio.Queue()
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+
+    @property
+    def backlog(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def _start(self):
+        for worker in self.workers:
+            self._idle.put_nowait(worker)
+        self._dispatcher = self.loop.create_task(self._dispatch())
+
+    async def _next_job(self):
+        while True:
+            while not self._order:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            guild_id = self._order.popleft()
+            queue = self._queues[guild_id]
+            job = queue.popleft()
+            if queue:
+                self._order.append(guild_id)
+            else:
+                del self._queues[guild_id]
+            if not job.future.done():  # skip jobs cancelled while waiting
+                return job
+
+    async def _dispatch(self):
+        while True:
+            worker = await self._idle.get()
+            job = await self._next_job()
+            job.worker = worker
+            self.loop.create_task(self._run(job))
+
+    async def _run(self, job):
+        worker = job.worker
+        try:
+            result = await worker.run(job.payload, job.timeout)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            job.worker = None
+            self._idle.put_nowait(worker)
+
+    def _finish(self, job):
+        if self._jobs.get(job.key) is job:
+            del self._jobs[job.key]
+
+    def _cancel(self, job):
+        job.future.cancel()
+        if job.worker is not None:
+            job.worker.kill()  # respawned on its next job
+
+    async def submit(self, guild_id, payload, *, key=None, timeout=None):
+        if self._dispatcher is None:
+            self._start()
+
+        job = self._jobs.get(key) if key is not None else None
+        if job is None:
+            job = Job(guild_id, key, payload, timeout or self.timeout, self.loop.create_future())
+            job.future.add_done_callback(lambda _: self._finish(job))
+            if key is not None:
+                self._jobs[key] = job
+            if guild_id not in self._queues:
+                self._queues[guild_id] = deque()
+                self._order.append(guild_id)
+            self._queues[guild_id].append(job)
+            self._wakeup.set()
+
+        job.waiters[guild_id] += 1
+        try:
+            return await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            if sum(job.waiters.values()) == 1 and not job.future.done():
+                self._cancel(job)
+            raise
+        finally:
+            job.waiters[guild_id] -= 1
+            if not job.waiters[guild_id]:
+                del job.waiters[guild_id]
+
+    async def extract(self, query, *, guild_id=None):
+        """Resolves a query to compact info about a single track."""
+        return await self.submit(guild_id, {'op': 'extract', 'query': query}, key=('extract', normalize_query(query)))
+
+    async def playlist(self, url, *, limit=None, guild_id=None):
+        """Lists a playlist's entries without resolving any of them."""
+        payload = {'op': 'playlist', 'url': url, 'limit': limit}
+        return await self.submit(guild_id, payload, key=('playlist', url, limit))
+
+    async def download(self, data, template, *, guild_id=None):
+        """Downloads resolved info and returns the filename."""
+        payload = {'op': 'download', 'data': data, 'template': template}
+        return await self.submit(guild_id, payload, key=('download', data['webpage_url']),
+                                 timeout=self.download_timeout)
+
+    def cancel_guild(self, guild_id):
+        """Drops the queued jobs only this guild is waiting on.
+        Jobs merged with other guilds' identical requests stay queued for them.
+        """
+        queue = self._queues.get(guild_id)
+        if queue is None:
+            return
+        for job in queue:
+            if not set(job.waiters) - {guild_id}:
+                job.future.cancel()
+        kept = deque(job for job in queue if not job.future.done())
+        if kept:
+            self._queues[guild_id] = kept
+            return
+        del self._queues[guild_id]
+        try:
+            self._order.remove(guild_id)
+        except ValueError:
+            pass
+
+    def close(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+        for worker in self.workers:
+            worker.kill()
+
+
+def _compact(data):
+    return {k: data.get(k) for k in compact_keys}
+
+
+def _flat_entry(entry):
+    url = entry.get('url') or entry.get('id')
+    if not url.startswith(('http://', 'https://')) and entry.get('ie_key') == 'Youtube':
+        url = 'https://www.youtube.com/watch?v=' + url
+    return {'id': entry.get('id'), 'title': entry.get('title') or url,
+            'duration': entry.get('duration'), 'webpage_url': url}
+
+
+def _list_playlist(ydl, url, limit):
+    params = dict(ydl.params)
+    ydl.params.update(extract_flat='in_playlist', noplaylist=False, playlistend=limit)
+    try:
+        data = ydl.extract_info(url, download=False)
+    finally:
+        ydl.params = params
+    entries = data.get('entries') or [data]
+    return {'title': data.get('title'), 'entries': [_flat_entry(e) for e in entries if e]}
+
+
+def main():
+    import youtube_dl
+
+    # Suppress noise about console usage from errors
+    youtube_dl.utils.bug_reports_message = lambda: ''
+
+    # keep stdout for replies only, youtube_dl output goes to stderr
+    out = sys.stdout
+    sys.stdout = sys.stderr
+    ydl = youtube_dl.YoutubeDL(ytdl_format_options)
+
+    for line in sys.stdin:
+        job = json.loads(line)
+        try:
+            if job['op'] == 'extract':
+                data = ydl.extract_info(job['query'], download=False)
+                if 'entries' in data:
+                    # take first item from a playlist
+                    data = data['entries'][0]
+                result = _compact(data)
+            elif job['op'] == 'playlist':
+                result = _list_playlist(ydl, job['url'], job['limit'])
+            elif job['op'] == 'download':
+                data = job['data']
+                ydl.params['outtmpl'] = job['template']
+                result = ydl.prepare_filename(data)
+                if not os.path.exists(result):
+                    ydl.dl(result, data)
+            else:
+                raise ValueError('Unknown op {}'.format(job['op']))
+            reply = {'ok': True, 'result': result}
+        except Exception as e:
+            reply = {'ok': False, 'error': str(e)}
+        out.write(json.dumps(reply) + '\n')
+        out.flush()
+
+
+if __name__ == '__main__':
+    main()
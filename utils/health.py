@@ -0,0 +1,123 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+
+from utils import metrics
+
+
+class LoopMonitor:
+    """Notices the event loop stalling, and what it was busy with at the time.
+    A heartbeat on the loop runs every `interval` seconds and measures how late
+    it ran. A daemon thread watches the heartbeat; once it's `threshold` seconds
+    late, the thread grabs the loop thread's stack, which is still inside
+    whatever is blocking it. The stall is logged and counted when the loop gets
+    going again. Cheap enough to leave running: ten callbacks a second and a
+    thread that mostly sleeps.
+    """
+    def __init__(self, loop, *, interval=0.1, threshold=0.25, keep=20):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls = deque(maxlen=keep)  # (unix time, seconds, stack) of the latest stalls
+        self.thread_id = None  # the loop's thread
+        self._expected = None
+        self._stack = None  # captured by the watcher during a stall in progress
+        self._handle = None
+        self._closed = threading.Event()
+
+    def start(self):
+        """Starts monitoring, must be called from the loop's thread."""
+        self.thread_id = threading.get_ident()
+        self._expected = time.monotonic()
+        self._beat()
+        threading.Thread(target=self._watch, name='loop-monitor', daemon=True).start()
+
+    def _beat(self):
+        now = time.monotonic()
+        lag = now - self._expected
+        metrics.loop_lag_seconds.observe(lag)
+        if lag >= self.threshold:
+            stack, self._stack = self._stack, None
+            self.stalls.append((time.time(), lag, stack))
+            metrics.loop_stalls.inc()
+            print(f"Event loop stalled for {lag:.3f}s" + (f" in:\n{stack}" if stack else "."))
+        self._stack = None
+        self._expected = now + self.interval
+        self._handle = self.loop.call_later(self.interval, self._beat)
+
+    def _watch(self):
+        while not self._closed.wait(self.interval):
+            if self._stack is None and time.monotonic() - self._expected >= self.threshold:
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is not None:
+                    self._stack = ''.join(traceback.format_stack(frame))
+
+    def close(self):
+        self._closed.set()
+        if self._handle is not None:
+            self._handle.cancel()
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def sample(seconds, *, interval=0.005):
+    """Samples the stacks of every other thread for `seconds`, returns how often each stack was seen.
+    Stacks are folded to `thread;outer;...;inner`, the format flame graph tools read.
+    """
+    counts = Counter()
+    me = threading.get_ident()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return counts
+
+
+async def profile(seconds, *, interval=0.005, loop=None):
+    """Runs `sample` on a thread of its own, the default executor might be what's stuck."""
+    loop = loop or asyncio.get_event_loop()
+    future = loop.create_future()
+
+    def run():
+        try:
+            result = sample(seconds, interval=interval)
+        except Exception as e:
+            loop.call_soon_threadsafe(future.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(future.set_result, result)
+
+    threading.Thread(target=run, name='profiler', daemon=True).start()
+    return await future
+
+
+def format_profile(counts):
+    return '\n'.join(f'{stack} {n}' for stack, n in counts.most_common()) + '\n'
+
+
+def describe_task(task):
+    """What a task runs and where it's suspended."""
+    frames = task.get_stack(limit=1)
+    if task.done():
+        where = 'cancelled' if task.cancelled() else 'done'
+    elif frames:
+        frame = frames[0]
+        where = f'{frame.f_code.co_name} at {os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno}'
+    else:
+        where = 'pending'
+    return where
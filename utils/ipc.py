@@ -0,0 +1,65 @@
+import asyncio
+import itertools
+import threading
+
+
+class ClusterIPC:
+    """The worker side of the pipe to the cluster launcher.
+    Sends heartbeats so the launcher can tell a stuck worker from a busy one,
+    answers the launcher's requests with the registered handlers, and lets
+    the bot ask every worker something through `gather`.
+    """
+    def __init__(self, conn, *, worker_id, interval=5, loop=None):
+        self.conn = conn
+        self.worker_id = worker_id
+        self.interval = interval
+        self.loop = loop or asyncio.get_event_loop()
+        self.handlers = {}  # op -> callable returning a picklable reply
+        self._waiting = {}  # nonce -> future
+        self._nonces = itertools.count()
+        self._task = None
+
+    def start(self):
+        threading.Thread(target=self._reader, name='ipc-reader', daemon=True).start()
+        self._task = self.loop.create_task(self._heartbeat())
+
+    def _reader(self):
+        while True:
+            try:
+                msg = self.conn.recv()
+            except (EOFError, OSError):
+                return  # launcher is gone
+            self.loop.call_soon_threadsafe(self._dispatch, msg)
+
+    async def _heartbeat(self):
+        while True:
+            self.conn.send({'op': 'heartbeat', 'worker': self.worker_id})
+            await asyncio.sleep(self.interval)
+
+    def _dispatch(self, msg):
+        if msg['op'] == 'reply':
+            fut = self._waiting.pop(msg['nonce'], None)
+            if fut is not None and not fut.done():
+                fut.set_result(msg['data'])
+            return
+
+        handler = self.handlers.get(msg['op'])
+        try:
+            data = handler(**msg.get('args', {})) if handler else None
+        except Exception as e:
+            data = {'error': str(e)}
+        self.conn.send({'op': 'reply', 'nonce': msg['nonce'], 'worker': self.worker_id, 'data': data})
+
+    async def gather(self, op, *, timeout=5, **args):
+        """Runs `op` on every worker, this one included, and returns their replies by worker id."""
+        nonce = next(self._nonces)
+        fut = self._waiting[nonce] = self.loop.create_future()
+        self.conn.send({'op': 'gather', 'nonce': nonce, 'worker': self.worker_id, 'request': op, 'args': args})
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            self._waiting.pop(nonce, None)
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
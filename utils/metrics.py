@@ -0,0 +1,188 @@
+import asyncio
+import time
+
+registry = []
+
+default_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names, values, extra=''):
+    pairs = ['{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"')) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = labels
+        self._children = {}
+        registry.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(f'{name}{labels} {value}' for name, labels, value in self._samples())
+        return '\n'.join(lines)
+
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        for values, child in self._children.items():
+            yield self.name, _format_labels(self.label_names, values), child.value
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=default_buckets):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _samples(self):
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, child.counts):
+                cumulative += count
+                yield self.name + '_bucket', _format_labels(self.label_names, values, f'le="{bound}"'), cumulative
+            yield self.name + '_bucket', _format_labels(self.label_names, values, 'le="+Inf"'), child.count
+            yield self.name + '_sum', _format_labels(self.label_names, values), child.sum
+            yield self.name + '_count', _format_labels(self.label_names, values), child.count
+
+
+class Gauge(Metric):
+    """A value read from `func` whenever the metrics are scraped."""
+    type = 'gauge'
+
+    def __init__(self, name, documentation, func=None):
+        super().__init__(name, documentation)
+        self.func = func
+
+    def _samples(self):
+        value = self.func() if self.func is not None else None
+        if value is not None:
+            yield self.name, '', value
+
+
+command_seconds = Histogram('shinobot_command_seconds', 'Time from receiving a command to finishing it.',
+                            labels=('command',))
+resolve_seconds = Histogram('shinobot_resolve_seconds', 'Time spent resolving a query with the extractor.')
+info_cache_lookups = Counter('shinobot_info_cache_lookups_total', 'Info cache lookups.', labels=('result',))
+probe_seconds = Histogram('shinobot_probe_seconds', 'Time spent reading an uploaded file with ffprobe.')
+catalog_lookups = Counter('shinobot_catalog_lookups_total', 'Track catalog lookups.', labels=('result',))
+download_seconds = Histogram('shinobot_download_seconds', 'Time spent downloading a song into the audio cache.')
+ffmpeg_spawn_seconds = Histogram('shinobot_ffmpeg_spawn_seconds', 'Time spent starting an ffmpeg process.')
+first_frame_seconds = Histogram('shinobot_first_frame_seconds', 'Time from starting ffmpeg to its first frame.')
+song_gap_seconds = Histogram('shinobot_song_gap_seconds', 'Silence between the end of a song and the next one.')
+resolves_refused = Counter('shinobot_resolves_refused_total', 'Play requests turned away while busy.')
+loop_lag_seconds = Histogram('shinobot_loop_lag_seconds', 'How late the event loop ran a scheduled heartbeat.')
+loop_stalls = Counter('shinobot_loop_stalls_total', 'Times the event loop was blocked past the stall threshold.')
+
+voice_states = Gauge('shinobot_voice_states', 'Voice states alive.')
+playing = Gauge('shinobot_playing', 'Voice clients currently playing.')
+queued_songs = Gauge('shinobot_queued_songs', 'Songs waiting in all queues.')
+extractor_backlog = Gauge('shinobot_extractor_backlog', 'Extractor jobs waiting for a worker.')
+resolves_active = Gauge('shinobot_resolves_active', 'Play requests being resolved.')
+resolves_waiting = Gauge('shinobot_resolves_waiting', 'Play requests waiting for their turn to resolve.')
+db_pool_size = Gauge('shinobot_db_pool_size', 'Connections open in the database pool.')
+db_pool_idle = Gauge('shinobot_db_pool_idle', 'Idle connections in the database pool.')
+
+
+def render():
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+async def _handle(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass  # skip the headers
+        if request.split(b' ')[1:2] == [b'/metrics']:
+            status, body = '200 OK', render().encode()
+        else:
+            status, body = '404 Not Found', b''
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(port, *, host='127.0.0.1'):
+    """Serves the metrics in Prometheus' text format on /metrics."""
+    return await asyncio.start_server(_handle, host, port)
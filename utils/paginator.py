@@ -1,4 +1,7 @@
 import asyncio
+import inspect
+import math
+
 import discord
 
 
@@ -6,6 +9,129 @@ class CannotPaginate(Exception):
     pass
 
 
+class Prompt:
+    """A pending "what page" question, answered by the author's next number in the channel."""
+    def __init__(self, key, loop):
+        self.key = key
+        self.future = loop.create_future()
+
+    def expire(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class SessionRegistry:
+    """Routes reactions and page number replies to paginator sessions.
+    A single raw reaction listener and a single message listener look sessions
+    up by message id and prompts by channel and author, instead of every
+    session running its own `wait_for` check on every event. Timeouts are kept
+    on a timer wheel with one slot per `tick` seconds.
+    """
+    def __init__(self, bot, *, slots=256, tick=1.0):
+        self.bot = bot
+        self.tick = tick
+        self.sessions = {}  # message id -> Pages
+        self.prompts = {}  # (channel id, author id) -> Prompt
+        self._wheel = [set() for _ in range(slots)]
+        self._slots = {}  # session or prompt -> its slot in the wheel
+        self._position = 0
+        bot.add_listener(self.on_raw_reaction_add)
+        bot.add_listener(self.on_message)
+        self._task = bot.loop.create_task(self._run())
+
+    @classmethod
+    def for_bot(cls, bot):
+        registry = getattr(bot, 'paginators', None)
+        if registry is None:
+            registry = bot.paginators = cls(bot)
+        return registry
+
+    def schedule(self, item, timeout):
+        """(Re)starts `item`'s timeout, `item.expire()` is called once it runs out."""
+        self.cancel(item)
+        ticks = min(max(math.ceil(timeout / self.tick), 1), len(self._wheel) - 1)
+        slot = (self._position + ticks) % len(self._wheel)
+        self._wheel[slot].add(item)
+        self._slots[item] = slot
+
+    def cancel(self, item):
+        slot = self._slots.pop(item, None)
+        if slot is not None:
+            self._wheel[slot].discard(item)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self._position = (self._position + 1) % len(self._wheel)
+            expired, self._wheel[self._position] = self._wheel[self._position], set()
+            for item in expired:
+                del self._slots[item]
+                item.expire()
+
+    def register(self, session, timeout):
+        self.sessions[session.message.id] = session
+        self.schedule(session, timeout)
+
+    def unregister(self, session):
+        self.sessions.pop(session.message.id, None)
+        self.cancel(session)
+
+    async def wait_for_number(self, channel, author, timeout):
+        """Waits for `author` to send a number in `channel`, returns the message or None."""
+        key = (channel.id, author.id)
+        prompt = self.prompts[key] = Prompt(key, self.bot.loop)
+        self.schedule(prompt, timeout)
+        try:
+            return await prompt.future
+        finally:
+            self.cancel(prompt)
+            if self.prompts.get(key) is prompt:
+                del self.prompts[key]
+
+    async def on_raw_reaction_add(self, payload):
+        session = self.sessions.get(payload.message_id)
+        if session is not None and payload.user_id == session.author.id:
+            session.react(str(payload.emoji), payload.user_id)
+
+    async def on_message(self, message):
+        if not self.prompts or not message.content.isdigit():
+            return
+        prompt = self.prompts.get((message.channel.id, message.author.id))
+        if prompt is not None and not prompt.future.done():
+            prompt.future.set_result(message)
+
+
+class PageSource:
+    """Builds the entries of a single page on demand, so only pages that get shown are built.
+    `get_page` can be a plain method or a coroutine. `version` should change
+    whenever the underlying entries do, which drops already rendered pages.
+    """
+    per_page = 12
+
+    @property
+    def version(self):
+        return None
+
+    def count(self):
+        raise NotImplementedError
+
+    def get_page(self, page):
+        raise NotImplementedError
+
+
+class ListPageSource(PageSource):
+    def __init__(self, entries, *, per_page=12):
+        self.entries = entries
+        self.per_page = per_page
+
+    def count(self):
+        return len(self.entries)
+
+    def get_page(self, page):
+        base = (page - 1) * self.per_page
+        return self.entries[base:base + self.per_page]
+
+
 class Pages:
     """Implements a paginator that queries the user for the
     pagination interface.
@@ -20,8 +146,10 @@ class Pages:
         The message that initiated this session.
     entries
         A list of entries to paginate.
+    source
+        A PageSource to paginate instead of `entries`.
     per_page
-        How many entries show up per page.
+        How many entries show up per page, when paginating `entries`.
     Attributes
     -----------
     embed: discord.Embed
@@ -31,18 +159,17 @@ class Pages:
     permissions: discord.Permissions
         Our permissions for the channel.
     """
-    def __init__(self, bot, *, message, entries, per_page=12):
+    def __init__(self, bot, *, message, entries=None, source=None, per_page=12):
         self.bot = bot
-        self.entries = entries
+        self.source = source if source is not None else ListPageSource(entries, per_page=per_page)
         self.message = message
         self.author = message.author
-        self.per_page = per_page
-        pages, left_over = divmod(len(self.entries), self.per_page)
-        if left_over:
-            pages += 1
-        self.maximum_pages = pages
+        self.per_page = self.source.per_page
         self.embed = discord.Embed()
-        self.paginating = len(entries) > per_page
+        self.paginating = self.source.count() > self.per_page
+        self._rendered = {}  # page -> lines, for the source version in _version
+        self._version = self.source.version
+        self._events = None
         self.reaction_emojis = [
             ('\N{BLACK LEFT-POINTING DOUBLE TRIANGLE WITH VERTICAL BAR}', self.first_page),
             ('\N{BLACK LEFT-POINTING TRIANGLE}', self.previous_page),
@@ -62,18 +189,45 @@ class Pages:
         if not self.permissions.embed_links:
             raise CannotPaginate('Bot does not have embed links permission.')
 
-    def get_page(self, page):
-        base = (page - 1) * self.per_page
-        return self.entries[base:base + self.per_page]
+    @property
+    def maximum_pages(self):
+        pages, left_over = divmod(self.source.count(), self.per_page)
+        if left_over:
+            pages += 1
+        return max(pages, 1)
+
+    async def get_page(self, page):
+        if self.source.version != self._version:
+            self._rendered.clear()
+            self._version = self.source.version
+
+        lines = self._rendered.get(page)
+        if lines is None:
+            entries = self.source.get_page(page)
+            if inspect.isawaitable(entries):
+                entries = await entries
+            lines = ['%s. %s' % t for t in enumerate(entries, 1 + ((page - 1) * self.per_page))]
+            self._rendered[page] = lines
+        return lines
+
+    async def add_reactions(self):
+        for (reaction, _) in self.reaction_emojis:
+            if self.maximum_pages == 2 and reaction in ('\u23ed', '\u23ee'):
+                # no |<< or >>| buttons if we only have two pages
+                # we can't forbid it if someone ends up using it but remove
+                # it from the default set
+                continue
+
+            try:
+                await self.message.add_reaction(reaction)
+            except discord.HTTPException:
+                return  # the message is probably gone
 
     async def show_page(self, page, *, first=False):
         self.current_page = page
-        entries = self.get_page(page)
-        p = []
-        for t in enumerate(entries, 1 + ((page - 1) * self.per_page)):
-            p.append('%s. %s' % t)
+        p = list(await self.get_page(page))
 
-        self.embed.set_footer(text='Page %s/%s (%s entries)' % (page, self.maximum_pages, len(self.entries)))
+        self.embed.set_footer(text='Page %s/%s (%s entries)' % (page, self.maximum_pages, self.source.count()))
 
         if not self.paginating:
             self.embed.description = '\n'.join(p)
@@ -95,14 +249,8 @@ class Pages:
         p.append('Confused? React with \N{INFORMATION SOURCE} for more info.')
         self.embed.description = '\n'.join(p)
         self.message = await self.message.channel.send(embed=self.embed)
-        for (reaction, _) in self.reaction_emojis:
-            if self.maximum_pages == 2 and reaction in ('\u23ed', '\u23ee'):
-                # no |<< or >>| buttons if we only have two pages
-                # we can't forbid it if someone ends up using it but remove
-                # it from the default set
-                continue
-
-            await self.message.add_reaction(reaction)
+        # the page is up already, the reactions trickle in behind it
+        self.bot.loop.create_task(self.add_reactions())
 
     async def checked_show_page(self, page):
         if page != 0 and page <= self.maximum_pages:
@@ -133,9 +281,8 @@ class Pages:
         to_delete = []
         to_delete.append(await self.message.channel.send('What page do you want to go to?'))
 
-        def check(m):
-            return m.content.isdigit() and m.channel == self.message.channel and m.author == self.author
-        msg = await self.bot.wait_for("message", check=check, timeout=30.0)
+        registry = SessionRegistry.for_bot(self.bot)
+        msg = await registry.wait_for_number(self.message.channel, self.author, 30.0)
 
         if msg is not None:
             page = int(msg.content)
@@ -180,36 +327,42 @@ class Pages:
         await self.message.delete()
         self.paginating = False
 
+    def react(self, emoji, user_id):
+        for (e, func) in self.reaction_emojis:
+            if emoji == e:
+                self._events.put_nowait((func, emoji, user_id))
+                return
+
+    def expire(self):
+        self._events.put_nowait(None)
+
     async def paginate(self):
         """Actually paginate the entries and run the interactive loop if necessary."""
         await self.show_page(1, first=True)
+        if not self.paginating:
+            return
 
-        def react_check(reaction, user):
-            if user is None or user.id != self.author.id:
-                return False
-            if self.message.id != reaction.message.id:
-                return False
-
-            for (emoji, func) in self.reaction_emojis:
-                if reaction.emoji == emoji:
-                    self.match = func
-                    return True
-            return False
-        while self.paginating:
-            try:
-                react = await self.bot.wait_for("reaction_add", check=react_check, timeout=120.0)
-            except asyncio.TimeoutError:
-                self.paginating = False
-                try:
-                    await self.message.clear_reactions()
-                except Exception:
-                    pass
-                finally:
+        self._events = asyncio.Queue()
+        registry = SessionRegistry.for_bot(self.bot)
+        registry.register(self, 120.0)
+        try:
+            while self.paginating:
+                event = await self._events.get()
+                if event is None:  # timed out
+                    self.paginating = False
+                    try:
+                        await self.message.clear_reactions()
+                    except Exception:
+                        pass
                     break
 
-            try:
-                await self.message.remove_reaction(react[0], react[1])
-            except Exception:
-                pass  # can't remove it so don't bother doing so
+                func, emoji, user_id = event
+                try:
+                    await self.message.remove_reaction(emoji, discord.Object(id=user_id))
+                except Exception:
+                    pass  # can't remove it so don't bother doing so
 
-            await self.match()
+                await func()
+                registry.schedule(self, 120.0)
+        finally:
+            registry.unregister(self)
@@ -0,0 +1,68 @@
+import asyncio
+from collections import OrderedDict
+
+import discord
+
+
+class PresenceManager:
+    """Publishes the bot's presence for every guild at once.
+    Voice states only report what they play; at most one presence update is
+    sent per `interval` seconds, and only if it would actually change.
+    The policy picks what's shown while something plays:
+    `recent` is the most recently started song, `count` the number of guilds
+    playing, and `off` never touches the presence.
+    """
+    def __init__(self, bot, *, interval=15, policy='recent', idle=None):
+        self.bot = bot
+        self.interval = interval
+        self.policy = policy
+        self.idle = idle  # shown when nothing plays anywhere
+        self.playing = OrderedDict()  # guild_id -> title, most recently started last
+        self._changed = asyncio.Event()
+        self._shown = idle.name if idle else None
+        self._task = None
+
+    def start(self):
+        if self.policy != 'off':
+            self._task = self.bot.loop.create_task(self._run())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def now_playing(self, guild_id, title):
+        self.playing.pop(guild_id, None)
+        self.playing[guild_id] = title
+        self._changed.set()
+
+    def stopped(self, guild_id):
+        if self.playing.pop(guild_id, None) is not None:
+            self._changed.set()
+
+    def activity(self):
+        if not self.playing:
+            return self.idle
+        if self.policy == 'count':
+            n = len(self.playing)
+            return discord.Game(name=f"music in {n} server{'s' if n != 1 else ''}", type=2)
+        return discord.Game(name=next(reversed(self.playing.values())), type=2)
+
+    async def _run(self):
+        await self.bot.wait_until_ready()
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            activity = self.activity()
+            name = activity.name if activity else None
+            if name != self._shown:
+                try:
+                    await self.bot.change_presence(activity=activity)
+                except asyncio.CancelledError:
+                    raise  # an Exception before 3.8, close() has to end the loop
+                except Exception as e:
+                    # e.g. a shard reconnecting, try again after the interval
+                    print(f"Couldn't change presence:\n    {e}")
+                    self._changed.set()
+                else:
+                    self._shown = name
+            await asyncio.sleep(self.interval)
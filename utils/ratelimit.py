@@ -0,0 +1,32 @@
+import time
+from collections import OrderedDict
+
+
+class RateLimiter:
+    """Token buckets keyed by anything hashable, e.g. a user or guild id.
+    Each key may spend `burst` tokens at once, refilled at `rate` per second.
+    Only the `maxsize` most recently used buckets are kept; a dropped bucket
+    would have refilled completely by then anyway.
+    """
+    def __init__(self, rate, burst, *, maxsize=10000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # key -> [tokens, last update]
+
+    def allow(self, key, now=None):
+        now = now if now is not None else time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
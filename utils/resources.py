@@ -1,125 +1,498 @@
 import asyncio
-import os
+import audioop
+import json
+import threading
+import time
 
 import discord
-import youtube_dl
-from mutagen.mp3 import MP3
-
-# Suppress noise about console usage from errors
-youtube_dl.utils.bug_reports_message = lambda: ''
-
-
-ytdl_format_options = {
-    'format': 'bestaudio/best',
-    'outtmpl': '%(title)s.%(ext)s',
-    'restrictfilenames': True,
-    'noplaylist': True,
-    'nocheckcertificate': True,
-    'ignoreerrors': False,
-    'logtostderr': False,
-    'quiet': True,
-    'no_warnings': True,
-    'default_search': 'ytsearch',
-    'source_address': '0.0.0.0'  # ipv6 addresses cause issues sometimes
-}
+
+from utils import metrics
+from utils.audio import FFmpegOpusAudio
+from utils.cache import AudioCache
+from utils.tracks import TrackQueue
 
 ffmpeg_options = {
     'before_options': '-nostdin',
     'options': '-vn'
 }
 
-ytdl = youtube_dl.YoutubeDL(ytdl_format_options)
+# used when playing straight from the resolved media url instead of a downloaded file
+ffmpeg_stream_options = {
+    'before_options': '-nostdin -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+    'options': '-vn'
+}
 
 
-async def get_song_length(query):
-    loop = asyncio.get_event_loop()
-    data = await loop.run_in_executor(None, ytdl.extract_info, query, False)  # get data
-    if 'entries' in data:
-        data = data['entries'][0]
-    return data['duration']
+async def resolve(query, *, pool, guild_id=None, cache=None, catalog=None, stream=True):
+    """Resolves a query to the info of a single track.
+    The result is used both for length checks and for building the player.
+    Without `stream`, catalog info whose media url has expired is good enough,
+    the song gets resolved again before it plays.
+    """
+    if cache is not None:
+        data = cache.get(query)
+        metrics.info_cache_lookups.labels('miss' if data is None else 'hit').inc()
+        if data is not None:
+            return data
 
+    if catalog is not None:
+        data = await catalog.get(query)
+        metrics.catalog_lookups.labels('miss' if data is None else 'hit').inc()
+        if data is not None and (data.get('url') or not stream):
+            if data.get('url') and cache is not None:
+                cache.put(query, data)
+            return data
 
-class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume=0.5):
-        super().__init__(source, volume)
+    with metrics.resolve_seconds.time():
+        data = await pool.extract(query, guild_id=guild_id)
+    if cache is not None:
+        cache.put(query, data)
+    if catalog is not None:
+        catalog.put(query, data)
+    return data
+
+
+async def download(data, cache, *, pool, guild_id=None):
+    """Makes sure a song is in the audio cache and holds a reference to it.
+    The caller is responsible for releasing the reference.
+    """
+    key = cache.key_for(data)
+    cache.acquire(key)  # hold it before awaiting anything so it can't be evicted under us
+    try:
+        filename = cache.get(key)
+        if filename is None:
+            # identical downloads from other guilds are merged by the pool
+            with metrics.download_seconds.time():
+                filename = await pool.download(data, cache.template, guild_id=guild_id)
+            cache.add(key, filename)
+        return key, filename
+    except BaseException:
+        cache.release(key)
+        raise
+
+
+class TrackError(Exception):
+    pass
+
+
+async def probe(url, *, timeout=30):
+    """Reads the format, audio codec and duration of anything ffmpeg can play.
+    ffprobe only fetches as much of the file as it needs to tell.
+    """
+    args = ['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-of', 'json',
+            '-show_entries', 'format=format_name,duration:stream=codec_name', url]
+    try:
+        process = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL,
+                                                       stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.DEVNULL)
+    except FileNotFoundError:
+        raise TrackError('ffprobe was not found.') from None
+    try:
+        with metrics.probe_seconds.time():
+            out, _ = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise TrackError("Timed out reading the file.") from None
+    if process.returncode != 0:
+        raise TrackError("That file can't be played.")
+
+    info = json.loads(out.decode())
+    streams = info.get('streams')
+    if not streams:
+        raise TrackError("That file has no audio.")
+    duration = info.get('format', {}).get('duration')
+    return {
+        'format': info.get('format', {}).get('format_name'),
+        'codec': streams[0].get('codec_name'),
+        'duration': float(duration) if duration not in (None, 'N/A') else None,
+    }
+
+
+async def resolve_attachment(attachment, *, max_bytes=None, max_length=None):
+    """Checks an uploaded file and returns info to stream it from Discord like any other song."""
+    if max_bytes and attachment.size > max_bytes:
+        raise TrackError(f"File is too big! Limit is `{max_bytes // (1024 * 1024)}` MB.")
+    info = await probe(attachment.url)
+    if max_length and max_length > 0:
+        if info['duration'] is None:
+            raise TrackError("Can't tell how long that file is.")
+        if info['duration'] > max_length:
+            raise TrackError(f"Song is too long! Limit is `{max_length}` seconds.")
+    return {
+        'id': str(attachment.id),
+        'extractor_key': 'Attachment',
+        'title': attachment.filename,
+        'duration': info['duration'],
+        'url': attachment.url,
+        'webpage_url': attachment.url,
+        'acodec': info['codec'],
+        'upload': True,  # nothing to resolve or download, ffmpeg reads it straight from discord
+    }
 
+
+def is_listener(member, voice=None):
+    """Whether a member in our channel counts towards skip votes and keeping the song playing."""
+    voice = voice or member.voice
+    return not member.bot and voice is not None and not (voice.deaf or voice.self_deaf)
+
+
+class Track:
+    """Bookkeeping shared by both kinds of song players."""
+    def _setup(self, data, filename=None, cache=None):
         self.data = data
 
         self.title = data.get('title')
         self.url = data.get('url')
         self.length = data.get('duration')
-        self.filename = ytdl.prepare_filename(data)
+        self.filename = filename  # None when streaming
+        self.cache = cache
+        # the player thread and the loop both clean up sources, only one of them may release the file
+        self._cache_lock = threading.Lock()
+        self._primed = None
+        self._started = time.perf_counter()
+
+    async def warm(self, *, loop=None):
+        """Waits for ffmpeg to produce the first frame so playback starts instantly."""
+        if self._primed is None:
+            loop = loop or asyncio.get_event_loop()
+            self._primed = await loop.run_in_executor(None, self._read_frame)
+            metrics.first_frame_seconds.observe(time.perf_counter() - self._started)
+
+    def cleanup(self):
+        super().cleanup()
+        with self._cache_lock:
+            cache, self.cache = self.cache, None
+        if cache is not None:
+            cache.release_threadsafe(AudioCache.key_for(self.data))
+
+    @staticmethod
+    def from_data(data, *, filename=None, cache=None, volume=0.5, opus=True, start=0):
+        """Builds a player for resolved info, playing `filename` from the audio cache if given.
+        `start` skips that many seconds into the song, for picking it up where it was left.
+        """
+        if filename is not None:
+            source, options = filename, ffmpeg_options
+        else:
+            # stream the media url, ffmpeg starts producing audio as soon as the first bytes arrive
+            source, options = data['url'], ffmpeg_stream_options
+        with metrics.ffmpeg_spawn_seconds.time():
+            if opus:
+                return OpusSource(source, data=data, volume=volume, start=start, filename=filename, cache=cache,
+                                  **options)
+            if start:
+                options = dict(options, before_options=f"{options['before_options']} -ss {start}")
+            return YTDLSource(discord.FFmpegPCMAudio(source, **options), data=data, volume=volume, start=start,
+                              filename=filename, cache=cache)
+
+
+class YTDLSource(Track, discord.PCMVolumeTransformer):
+    """Decodes to PCM and scales every frame in our process."""
+    def __init__(self, source, *, data, volume=0.5, start=0, **kwargs):
+        super().__init__(source, volume)
+        self.start = start
+        self.packets = 0
+        self._setup(data, **kwargs)
+
+    @property
+    def position(self):
+        """Seconds into the song, each frame is 20ms of audio."""
+        return self.start + self.packets * 0.02
+
+    def _read_frame(self):
+        return self.original.read()
+
+    def read(self):
+        if self._primed is not None:
+            frame, self._primed = self._primed, None
+            self.packets += 1
+            return audioop.mul(frame, 2, min(self.volume, 2.0))
+        frame = super().read()
+        if frame:
+            self.packets += 1
+        return frame
+
 
-    @classmethod
-    async def from_query(cls, query, *, loop=None):
-        loop = loop or asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, ytdl.extract_info, query)
-        if 'entries' in data:
-            # take first item from a playlist
-            data = data['entries'][0]
+class OpusSource(Track, FFmpegOpusAudio):
+    """Has ffmpeg emit opus packets, skipping decode, volume and encode in our process."""
+    def __init__(self, source, *, data, volume=0.5, start=0, before_options=None, options=None, **kwargs):
+        # already opus and nothing to change, the packets can be copied as they are
+        copy = data.get('acodec') == 'opus' and volume == 1.0
+        super().__init__(source, volume=volume, copy=copy, start=start,
+                         before_options=before_options, options=options)
+        self._setup(data, **kwargs)
 
-        filename = ytdl.prepare_filename(data)
-        return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data)
+    def _read_frame(self):
+        return FFmpegOpusAudio.read(self)
 
-    @classmethod
-    def from_file(cls, filename):
-        info = MP3(filename).info
-        data = {'title': filename, 'duration': info.length}
-        return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data)
+    def read(self):
+        if self._primed is not None:
+            packet, self._primed = self._primed, None
+            return packet
+        return super().read()
+
+    def restart(self, *, volume):
+        """Returns a new source picking up where this one is, at a different volume."""
+        position = self.position - (0.02 if self._primed is not None else 0)  # the primed packet wasn't played
+        return OpusSource(self.source, data=self.data, volume=volume, start=position,
+                          before_options=self.before_options, options=self.options, filename=self.filename)
+
+    def take_over(self, old):
+        """Moves the cache reference of the source this one replaces."""
+        with old._cache_lock:
+            cache, old.cache = old.cache, None
+        with self._cache_lock:
+            self.cache = cache
+
+
+class Song:
+    """A queued song. Its player is only built shortly before it comes up.
+    Only the requester and the channel it was queued from are kept, never the
+    command's context, so a song can be rebuilt from a snapshot after a restart.
+    """
+    def __init__(self, data, *, requester, channel, notif=None, start=0):
+        self.requester = requester
+        self.channel = channel  # where it's announced
+        self.id = None  # given by the queue
+        self.data = data
+        self.notif = notif if notif is not None else []
+        self.start = start  # seconds to skip, when resuming a song that was cut off
+        self.player = None
+        self.task = None  # prefetch in progress
+        self.filename = None
+        self.audio_cache = None  # set while we hold a reference to a cached file
+
+    @property
+    def title(self):
+        return self.data.get('title')
+
+    async def prepare(self, state, *, warm=False):
+        """Resolves and downloads the song, and starts its player if `warm`."""
+        if self.player is not None:
+            if self.player.volume != state.volume:
+                # started ahead of time, before the volume was changed
+                if isinstance(self.player, OpusSource):
+                    old, self.player = self.player, self.player.restart(volume=state.volume)
+                    self.player.take_over(old)
+                    old.cleanup()
+                else:
+                    self.player.volume = state.volume
+            if warm:
+                await self.player.warm(loop=state.bot.loop)
+            return
+
+        bot = state.bot
+        guild_id = state.guild.id
+        if self.filename is None and not self.data.get('upload'):
+            if state.download:
+                audio_cache = bot.audio_cache
+                if audio_cache.get(AudioCache.key_for(self.data)) is None:
+                    # the media url might have expired while the song was queued
+                    self.data = await resolve(self.data['webpage_url'], pool=bot.extractor, guild_id=guild_id,
+                                              cache=bot.info_cache, catalog=bot.catalog)
+                _, self.filename = await download(self.data, audio_cache, pool=bot.extractor, guild_id=guild_id)
+                self.audio_cache = audio_cache
+            else:
+                self.data = await resolve(self.data['webpage_url'], pool=bot.extractor, guild_id=guild_id,
+                                          cache=bot.info_cache, catalog=bot.catalog)
+
+            # playlist entries are only checked once they're resolved
+            max_len = state.length_max
+            if max_len and max_len > 0 and (self.data.get('duration') or 0) > max_len:
+                raise TrackError(f"Song is too long! Limit is `{max_len}` seconds.")
+
+        if warm:
+            self.player = Track.from_data(self.data, filename=self.filename, cache=self.audio_cache,
+                                          volume=state.volume, opus=state.opus, start=self.start)
+            self.audio_cache = None  # the player holds the reference now
+            await self.player.warm(loop=bot.loop)
+
+    def cleanup(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.player is not None:
+            self.player.cleanup()
+        elif self.audio_cache is not None:
+            self.audio_cache.release(AudioCache.key_for(self.data))
+            self.audio_cache = None
 
 
 class VoiceState:
+    """A guild's queue and player.
+    States are cheap to create: the player task only runs while there's
+    something to play, and the Music cog evicts states that have been idle
+    for a while.
+    The members listening in our channel are counted from voice state updates
+    as they happen; playback pauses while nobody is listening.
+    """
+    __slots__ = ('bot', 'guild', 'queue', 'current', 'play_next_song', 'skips', 'volume', 'ended',
+                 'pl_task', 'idle_since', 'listeners', 'empty_since')
+
     def __init__(self, bot, guild_id):
         self.bot = bot
         self.guild = bot.get_guild(guild_id)
-        self.queue = asyncio.Queue()
+        self.queue = TrackQueue()
         self.current = None
         self.play_next_song = asyncio.Event()
-        self.skips = []
-        self.pl_task = self.bot.loop.create_task(self.playlist())
-        self.master = None
-        conf = self.bot.config.get(self.guild.id)
-        if conf and conf.get('role_id'):
-            self.master = self.guild.get_role(conf['role_id'])
+        self.skips = set()
+        self.volume = 0.5
+        self.ended = None  # when the last song finished, for timing the gap to the next one
+        self.pl_task = None
+        self.idle_since = time.monotonic()
+        self.listeners = set()
+        self.empty_since = None  # when the last listener left
+        self.recount()
+
+    @property
+    def config(self):
+        return self.bot.configs.get(self.guild.id)
+
+    @property
+    def download(self):
+        download = self.config['download']
+        if download is None:
+            download = self.bot.settings.get('download', False)
+        return download
+
+    @property
+    def length_max(self):
+        return self.config['length_max']
+
+    @property
+    def lookahead(self):
+        return self.bot.settings.get('lookahead', 2)
+
+    @property
+    def opus(self):
+        return self.bot.settings.get('opus', True)
+
+    @property
+    def idle(self):
+        return (self.pl_task is None or self.pl_task.done()) and self.queue.empty()
+
+    def recount(self, channel=None):
+        """Counts the listeners from scratch, when we join or move to `channel`."""
+        if channel is None:
+            me = self.guild.me
+            channel = me.voice.channel if me.voice is not None else None
+        self.listeners = {m.id for m in channel.members if is_listener(m)} if channel is not None else set()
+        self.skips &= self.listeners
+        self.check_listeners()
+
+    def update_listener(self, member, listening):
+        """Counts a member joining, leaving or (un)deafening. Votes expire once the voter stops listening."""
+        if listening:
+            self.listeners.add(member.id)
+        else:
+            self.listeners.discard(member.id)
+            self.skips.discard(member.id)
+        self.check_listeners()
+
+    def check_listeners(self):
+        """Pauses while nobody is listening, and picks the song up again once someone is."""
+        if self.listeners:
+            self.empty_since = None
+        elif self.empty_since is None:
+            self.empty_since = time.monotonic()
+        voice = self.guild.voice_client
+        if voice is None:
+            return
+        if not self.listeners and voice.is_playing():
+            # the player stops reading, ffmpeg blocks on its full pipe and nothing is sent
+            voice.pause()
+            self.bot.presence.stopped(self.guild.id)
+        elif self.listeners and voice.is_paused():
+            voice.resume()
+            if self.current is not None:
+                self.bot.presence.now_playing(self.guild.id, self.current.title)
+
+    def touch(self):
+        """Restarts the idle timer."""
+        self.idle_since = time.monotonic()
+
+    def start(self):
+        """Starts playing the queue, if it isn't already."""
+        if self.pl_task is None or self.pl_task.done():
+            self.pl_task = self.bot.loop.create_task(self.playlist())
+
+    def close(self):
+        if self.pl_task is not None:
+            self.pl_task.cancel()
+        self.bot.presence.stopped(self.guild.id)
+        for song in self.queue.clear():
+            song.cleanup()
+
+    def prefetch(self):
+        """Prepares the next few songs in the queue while the current one plays.
+        The song right after the current one also gets its player started.
+        """
+        for i, song in enumerate(self.queue.peek(self.lookahead)):
+            warm = i == 0
+            if song.task is not None and (not warm or song.player is not None or not song.task.done()):
+                continue
+            song.task = self.bot.loop.create_task(song.prepare(self, warm=warm))
 
     def skip_song(self):
-        if len(self.skips) >= (len(self.current.ctx.voice_client.channel.members) - 1) * 0.34:
-            self.current.ctx.voice_client.stop()
+        voice = self.guild.voice_client
+        if len(self.skips) >= len(self.listeners) * 0.34:
+            voice.stop()
             self.toggle_song(None)
 
     def toggle_song(self, error):
         if error:
             print(error)
-        self.skips = []
+        self.skips = set()
+        self.ended = time.perf_counter()
         self.bot.loop.call_soon_threadsafe(self.play_next_song.set)
 
     async def playlist(self):
+        """Plays songs until the queue runs out."""
         await self.bot.wait_until_ready()
-        while not self.bot.is_closed():
+        self.ended = None  # waiting for someone to queue something isn't a gap
+        while not self.queue.empty() and not self.bot.is_closed():
             self.play_next_song.clear()
-            if self.current:
-                os.remove(self.current.player.filename)  # delete song after its played
+            self.current = self.queue.get_nowait()  # get next song
+            try:
+                await self.play_current()
+            finally:
+                self.current.cleanup()  # release the cached file
+                self.current = None
+        self.touch()
 
-            self.current = await self.queue.get()  # get next song
-            self.ctx = self.current.ctx
-            self.player = self.current.player
-            self.ctx.voice_client.play(self.player, after=self.toggle_song)  # play the song
+    async def play_current(self):
+        song = self.current
+        self.prefetch()
+        try:
+            if song.task is not None:
+                # usually done by now; prepare below redoes what a cancelled prefetch didn't get to
+                await asyncio.wait([song.task])
+                if not song.task.cancelled():
+                    song.task.result()  # raises what the prefetch failed with
+            await song.prepare(self, warm=True)
+        except asyncio.CancelledError:
+            raise  # an Exception before 3.8, the playlist itself is being stopped
+        except Exception as e:
+            self.bot.outbox.post(song.channel, f"Could not play `{song.title}`: {e}")
+            return
 
-            embed = discord.Embed(title="Now playing")  # build embed
-            embed.add_field(name="Queuer", value=self.ctx.author.name, inline=False)
-            embed.add_field(name="Song", value=self.player.title, inline=False)
+        voice = self.guild.voice_client
+        if voice is None:
+            return  # disconnected while the song was being prepared
+        player = song.player
+        voice.play(player, after=self.toggle_song)  # play the song
+        if self.ended is not None:
+            metrics.song_gap_seconds.observe(time.perf_counter() - self.ended)
+            self.ended = None
 
-            if self.ctx.guild.me.activity:
-                if self.ctx.guild.me.activity.name == "m!help":
-                    game = discord.Game(name=self.player.title, type=2)
-                    await self.bot.change_presence(activity=game)  # set presence to song
+        embed = discord.Embed(title="Now playing")  # build embed
+        embed.add_field(name="Queuer", value=song.requester.name, inline=False)
+        embed.add_field(name="Song", value=player.title, inline=False)
 
-            fmt = ", ".join(self.bot.get_user(uid).mention for uid in self.current.notif)
-            await self.ctx.send(fmt, embed=embed)
+        self.bot.presence.now_playing(self.guild.id, player.title)
 
-            await self.play_next_song.wait()
+        fmt = ", ".join(self.bot.get_user(uid).mention for uid in song.notif)
+        self.bot.outbox.now_playing(song.channel, embed, fmt)
+        self.check_listeners()  # starts out paused if everyone left while it was being prepared
 
-            if self.bot.dev:
-                await self.bot.change_presence()
-            else:
-                await self.bot.change_presence(activity=discord.Game(name="m!help"))
+        await self.play_next_song.wait()
+        self.bot.presence.stopped(self.guild.id)
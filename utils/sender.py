@@ -0,0 +1,106 @@
+import asyncio
+from collections import deque
+
+import discord
+
+
+class Pending:
+    __slots__ = ('kind', 'content', 'embed', 'lines')
+
+    def __init__(self, kind, content=None, embed=None, lines=None):
+        self.kind = kind
+        self.content = content
+        self.embed = embed
+        self.lines = lines
+
+
+class ChannelOutbox:
+    def __init__(self, channel, maxlen):
+        self.channel = channel
+        self.maxlen = maxlen
+        self.pending = deque()
+        self.now_playing = None  # the last now playing message, edited in place while it's the latest
+        self.task = None
+
+    def find(self, kind):
+        for item in self.pending:
+            if item.kind == kind:
+                return item
+        return None
+
+    def push(self, item):
+        self.pending.append(item)
+        while len(self.pending) > self.maxlen:
+            self.pending.popleft()  # too far behind, the oldest messages are stale anyway
+
+
+class Outbox:
+    """Sends bot messages through one queue per channel, so callers never wait on Discord.
+    When a channel falls behind, waiting "Enqueued" messages are merged into one,
+    and a waiting "Now playing" message is replaced by the newer one. The now playing
+    message is edited in place as long as nothing was posted after it.
+    """
+    def __init__(self, *, maxlen=20, loop=None):
+        self.maxlen = maxlen
+        self.loop = loop or asyncio.get_event_loop()
+        self._channels = {}  # channel id -> ChannelOutbox
+
+    def _outbox(self, channel):
+        outbox = self._channels.get(channel.id)
+        if outbox is None:
+            outbox = self._channels[channel.id] = ChannelOutbox(channel, self.maxlen)
+        return outbox
+
+    def _wake(self, outbox):
+        if outbox.task is None or outbox.task.done():
+            outbox.task = self.loop.create_task(self._run(outbox))
+
+    def post(self, channel, content=None, *, embed=None):
+        outbox = self._outbox(channel)
+        outbox.push(Pending(None, content, embed))
+        self._wake(outbox)
+
+    def enqueued(self, channel, title):
+        outbox = self._outbox(channel)
+        item = outbox.find('enqueued')
+        if item is None:
+            outbox.push(Pending('enqueued', lines=[title]))
+        else:
+            item.lines.append(title)
+        self._wake(outbox)
+
+    def now_playing(self, channel, embed, mentions=None):
+        outbox = self._outbox(channel)
+        item = outbox.find('now_playing')
+        if item is not None:
+            # that song is over already, nobody needs to hear about it anymore
+            outbox.pending.remove(item)
+        outbox.push(Pending('now_playing', mentions or None, embed))
+        self._wake(outbox)
+
+    async def _send(self, outbox, item):
+        channel = outbox.channel
+        if item.kind == 'enqueued':
+            lines = '\n'.join(f'     {title}' for title in item.lines)
+            await channel.send(f'Enqueued:\n{lines}')
+        elif item.kind == 'now_playing':
+            message = outbox.now_playing
+            # mentions don't ping in edits, so those always get a new message
+            if message is not None and item.content is None and channel.last_message_id == message.id:
+                try:
+                    return await message.edit(embed=item.embed)
+                except discord.NotFound:
+                    pass
+            outbox.now_playing = await channel.send(item.content, embed=item.embed)
+        else:
+            await channel.send(item.content, embed=item.embed)
+
+    async def _run(self, outbox):
+        while outbox.pending:
+            item = outbox.pending.popleft()
+            try:
+                await self._send(outbox, item)
+            except discord.HTTPException as e:
+                print(f"Couldn't send to #{outbox.channel}:\n    {e}")
+        if outbox.now_playing is None:
+            self._channels.pop(outbox.channel.id, None)
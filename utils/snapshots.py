@@ -0,0 +1,213 @@
+import asyncio
+import json
+import time
+
+from utils.resources import Song
+from utils.writebehind import WriteBehind
+
+schema = """
+    CREATE TABLE IF NOT EXISTS queue_snapshots (
+        guild_id BIGINT PRIMARY KEY,
+        voice_channel_id BIGINT NOT NULL,
+        volume REAL NOT NULL,
+        tracks TEXT NOT NULL,
+        saved_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+"""
+
+upsert_query = """
+    INSERT INTO queue_snapshots (guild_id, voice_channel_id, volume, tracks, saved_at)
+    VALUES ($1, $2, $3, $4, now())
+        ON CONFLICT (guild_id)
+        DO UPDATE SET voice_channel_id = EXCLUDED.voice_channel_id, volume = EXCLUDED.volume,
+                      tracks = EXCLUDED.tracks, saved_at = now()
+"""
+
+delete_query = """
+    DELETE FROM queue_snapshots
+    WHERE guild_id = ANY($1::bigint[])
+"""
+
+# enough of a song's info to show it and find it again, the rest is resolved when it comes up
+ref_keys = ('id', 'extractor', 'extractor_key', 'title', 'duration', 'webpage_url', 'acodec')
+
+
+def song_ref(song, *, position=0):
+    """A compact, json friendly reference to a queued song."""
+    ref = {k: song.data[k] for k in ref_keys if song.data.get(k) is not None}
+    if song.data.get('upload'):
+        # uploads can't be resolved again, ffmpeg reads them straight from discord
+        ref['url'] = song.data['url']
+        ref['upload'] = True
+    ref['requester'] = song.requester.id
+    ref['channel'] = song.channel.id
+    if song.notif:
+        ref['notif'] = song.notif
+    if position:
+        ref['start'] = round(position, 2)
+    return ref
+
+
+class QueueSnapshots(WriteBehind):
+    """Every guild's queue, current song and position, written behind to Postgres.
+    A guild is written again every `interval` seconds when its queue, current song
+    or volume changed, and every `position_interval` seconds while something plays,
+    so a restart loses at most that much of the song. Guilds whose queue ran out
+    or whose state was evicted have their snapshot removed.
+    After a restart, snapshots are restored one guild at a time in the background,
+    or right away when a guild sends a command before its turn came.
+    """
+    flush_error = "Couldn't save queues"
+
+    def __init__(self, bot, *, interval=5, position_interval=30, restore_delay=1, loop=None):
+        self.bot = bot
+        self.pool = bot.pool
+        self.interval = interval
+        self.position_interval = position_interval
+        self.restore_delay = restore_delay  # seconds between guilds, so reconnecting doesn't burst
+        self.loop = loop or asyncio.get_event_loop()
+        self._saved = {}  # guild_id -> (signature, monotonic time) of what was last written
+        self._unrestored = set()
+        self._restoring = {}  # guild_id -> task of a restore in progress
+        self._restore_task = None
+
+    async def setup(self):
+        await self.pool.execute(schema)
+
+    @staticmethod
+    def _signature(state):
+        current = state.current
+        voice = state.guild.voice_client
+        return (state.queue.version, current.id if current is not None else None, state.volume,
+                voice.channel.id if voice is not None else None)
+
+    @staticmethod
+    def _row(guild_id, state):
+        voice = state.guild.voice_client
+        if voice is None:
+            return None  # nowhere to resume
+        tracks = []
+        current = state.current
+        if current is not None:
+            player = current.player
+            tracks.append(song_ref(current, position=player.position if player is not None else current.start))
+        tracks.extend(song_ref(song) for song in state.queue)
+        if not tracks:
+            return None
+        return guild_id, voice.channel.id, state.volume, json.dumps(tracks, separators=(',', ':'))
+
+    async def flush(self, *, force=False):
+        """Writes the guilds that changed, and every playing one with `force`."""
+        now = time.monotonic()
+        saved = {}
+        rows, gone = [], []
+        for guild_id, state in list(self.bot.states.items()):
+            if guild_id in self._unrestored:
+                continue  # don't overwrite a snapshot that hasn't been restored yet
+            signature = self._signature(state)
+            last = self._saved.get(guild_id)
+            if last is not None and last[0] == signature and not force:
+                if state.current is None or now - last[1] < self.position_interval:
+                    continue
+            row = self._row(guild_id, state)
+            if row is not None:
+                rows.append(row)
+                saved[guild_id] = (signature, now)
+            elif last is not None:
+                gone.append(guild_id)
+        gone.extend(guild_id for guild_id in self._saved if guild_id not in self.bot.states)
+        if not rows and not gone:
+            return
+
+        async with self.pool.acquire() as con:
+            async with con.transaction():
+                if rows:
+                    await con.executemany(upsert_query, rows)
+                if gone:
+                    await con.execute(delete_query, gone)
+        self._saved.update(saved)
+        for guild_id in gone:
+            self._saved.pop(guild_id, None)
+
+    def restore_all(self):
+        """Starts restoring the snapshots of our guilds in the background."""
+        if self._restore_task is None:
+            self._restore_task = self.loop.create_task(self._restore_all())
+
+    async def _restore_all(self):
+        query = """
+            SELECT guild_id FROM queue_snapshots
+            WHERE guild_id = ANY($1::bigint[])
+            ORDER BY saved_at DESC
+        """
+        records = await self.pool.fetch(query, [g.id for g in self.bot.guilds])
+        guild_ids = [r['guild_id'] for r in records]
+        self._unrestored.update(guild_ids)
+        for guild_id in guild_ids:
+            if guild_id in self._unrestored:
+                await self.restore(guild_id)
+                await asyncio.sleep(self.restore_delay)
+
+    async def restore(self, guild_id):
+        """Restores a guild's snapshot if it's still waiting to be, cheap otherwise."""
+        if guild_id not in self._unrestored:
+            return
+        task = self._restoring.get(guild_id)
+        if task is None:
+            task = self._restoring[guild_id] = self.loop.create_task(self._restore(guild_id))
+        try:
+            await asyncio.shield(task)
+        finally:
+            self._restoring.pop(guild_id, None)
+            self._unrestored.discard(guild_id)
+
+    async def _restore(self, guild_id):
+        try:
+            await self._load(guild_id)
+        except Exception as e:
+            print(f"Couldn't restore the queue of {guild_id}:\n    {e}")
+
+    async def _load(self, guild_id):
+        query = """
+            SELECT * FROM queue_snapshots
+            WHERE guild_id = $1
+        """
+        record = await self.pool.fetchrow(query, guild_id)
+        guild = self.bot.get_guild(guild_id)
+        if record is None or guild is None:
+            return
+        # the row stays until the next flush replaces or removes it
+        self._saved[guild_id] = (None, time.monotonic())
+        channel = guild.get_channel(record['voice_channel_id'])
+        if channel is None:
+            return
+
+        songs = []
+        for ref in json.loads(record['tracks']):
+            requester = guild.get_member(ref.pop('requester'))
+            text = guild.get_channel(ref.pop('channel'))
+            if requester is None or text is None:
+                continue  # left the guild, or the channel is gone
+            notif = ref.pop('notif', None)
+            start = ref.pop('start', 0)
+            songs.append(Song(ref, requester=requester, channel=text, notif=notif, start=start))
+        if not songs:
+            return
+
+        await self.bot.configs.load(guild_id)
+        state = self.bot.get_state(guild_id)
+        if state.current is not None or not state.queue.empty():
+            return  # the queue is live, the next flush writes it over the snapshot
+        if guild.voice_client is None:
+            await channel.connect()
+        state.volume = record['volume']
+        for song in songs:
+            state.queue.put(song)  # these were all accepted before, limits aren't checked again
+        state.prefetch()
+        state.start()
+
+    async def close(self):
+        await self.stop()
+        if self._restore_task is not None:
+            self._restore_task.cancel()
+        await self.flush(force=True)
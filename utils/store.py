@@ -0,0 +1,224 @@
+import asyncio
+import uuid
+from collections import OrderedDict
+
+from utils.writebehind import WriteBehind
+
+columns = ('role_id', 'songs_max', 'length_max', 'locked', 'download', 'resolve_max', 'user_songs_max')
+
+# columns added after the table was first created
+migration = """
+    ALTER TABLE config
+        ADD COLUMN IF NOT EXISTS download BOOLEAN,
+        ADD COLUMN IF NOT EXISTS resolve_max INTEGER,
+        ADD COLUMN IF NOT EXISTS user_songs_max INTEGER
+"""
+
+upsert_query = """
+    INSERT INTO config (guild_id, {0})
+    VALUES ($1, {1})
+        ON CONFLICT (guild_id)
+        DO UPDATE SET {2}
+""".format(', '.join(columns),
+           ', '.join(f'${i}' for i in range(2, len(columns) + 2)),
+           ', '.join(f'{c} = EXCLUDED.{c}' for c in columns))
+
+notify_query = """
+    SELECT pg_notify('config_changed', $1 || ':' || guild_id::text)
+    FROM unnest($2::bigint[]) AS guild_id
+"""
+
+
+class ConfigStore(WriteBehind):
+    """Per-guild config held in memory and written behind to Postgres.
+    Guilds are loaded the first time they're seen and kept in a bounded LRU
+    cache. Changes load the guild first, since its whole row is written back,
+    then only mark it as dirty; dirty guilds are written in one batched upsert
+    every `interval` seconds and once more on close.
+    Every write is announced with NOTIFY so other processes sharing the table
+    reload that guild; when the listening connection drops, a new one is
+    opened and every cached guild is reloaded, since notifications were missed
+    in between. Locked members are kept as a set so checking them is cheap.
+    """
+    flush_error = "Couldn't write config"
+
+    def __init__(self, pool, *, interval=5, maxsize=10000, in_use=None, loop=None):
+        self.pool = pool
+        self.interval = interval
+        self.maxsize = maxsize
+        self.in_use = in_use or (lambda guild_id: False)  # guilds that must never be evicted
+        self.loop = loop or asyncio.get_event_loop()
+        self.id = uuid.uuid4().hex  # tells our own notifications apart from other processes'
+        self._configs = OrderedDict()
+        self._loading = {}  # guild_id -> future of a load in progress
+        self._dirty = set()
+        self._listener = None
+        self._closed = False
+        self._relisten_task = None
+
+    async def setup(self):
+        await self.pool.execute(migration)
+
+    @staticmethod
+    def _from_record(record):
+        config = {c: record.get(c) for c in columns}
+        config['locked'] = set(config['locked'] or ())
+        return config
+
+    async def _fetch(self, guild_id):
+        query = """
+            SELECT * FROM config
+            WHERE guild_id = $1
+        """
+        record = await self.pool.fetchrow(query, guild_id)
+        return self._from_record(dict(record) if record else {})
+
+    async def load(self, guild_id):
+        """Makes sure a guild's config is in memory, fetching it if needed."""
+        if guild_id in self._configs:
+            self._configs.move_to_end(guild_id)
+            return self._configs[guild_id]
+
+        fut = self._loading.get(guild_id)
+        if fut is None:
+            fut = self._loading[guild_id] = self.loop.create_task(self._fetch(guild_id))
+        try:
+            config = await asyncio.shield(fut)
+        finally:
+            self._loading.pop(guild_id, None)
+        if guild_id not in self._configs:  # might've been set while we were waiting
+            self._configs[guild_id] = config
+            self._evict()
+        return self._configs[guild_id]
+
+    def _evict(self):
+        if len(self._configs) <= self.maxsize:
+            return
+        for guild_id in list(self._configs)[:-1]:  # not the one that was just loaded
+            if len(self._configs) <= self.maxsize:
+                break
+            if guild_id not in self._dirty and not self.in_use(guild_id):
+                del self._configs[guild_id]
+
+    def get(self, guild_id):
+        """Returns a loaded guild's config, guilds that haven't been loaded get the defaults."""
+        config = self._configs.get(guild_id)
+        if config is None:
+            return self._from_record({})
+        return config
+
+    async def listen(self):
+        con = await self.pool.acquire()
+        try:
+            await con.add_listener('config_changed', self._on_notify)
+            if hasattr(con, 'add_termination_listener'):  # only on newer asyncpg
+                con.add_termination_listener(self._on_terminate)
+        except Exception:
+            await self.pool.release(con)
+            raise
+        self._listener = con
+
+    def _on_terminate(self, connection):
+        if not self._closed and (self._relisten_task is None or self._relisten_task.done()):
+            self._relisten_task = self.loop.create_task(self._relisten())
+
+    async def _relisten(self):
+        """Listens again on a new connection after ours dropped, then catches up on the changes we missed."""
+        old, self._listener = self._listener, None
+        if old is not None:
+            try:
+                await self.pool.release(old)
+            except Exception:
+                pass  # closed already, the pool just needs it back
+        delay = 1
+        while self._listener is None and not self._closed:
+            try:
+                await self.listen()
+            except Exception as e:
+                print(f"Couldn't listen for config changes, retrying in {delay}s:\n    {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+        if self._closed:
+            return
+        try:
+            await self._reload_all()
+        except Exception as e:
+            print(f"Couldn't reload config:\n    {e}")
+
+    def _on_notify(self, connection, pid, channel, payload):
+        origin, _, guild_id = payload.partition(':')
+        guild_id = int(guild_id)
+        if origin == self.id or guild_id not in self._configs or guild_id in self._dirty:
+            return
+        self.loop.create_task(self._reload(guild_id))
+
+    async def _reload(self, guild_id):
+        config = await self._fetch(guild_id)
+        current = self._configs.get(guild_id)
+        if current is not None and guild_id not in self._dirty:
+            # update in place, voice states and running commands hold on to the dict
+            current.update(config)
+
+    async def _reload_all(self):
+        query = """
+            SELECT * FROM config
+            WHERE guild_id = ANY($1::bigint[])
+        """
+        guild_ids = list(self._configs)
+        records = {r['guild_id']: r for r in await self.pool.fetch(query, guild_ids)}
+        for guild_id in guild_ids:
+            current = self._configs.get(guild_id)
+            if current is not None and guild_id not in self._dirty:
+                record = records.get(guild_id)
+                current.update(self._from_record(dict(record) if record else {}))
+
+    async def set(self, guild_id, key, value):
+        config = await self.load(guild_id)
+        config[key] = value
+        self._dirty.add(guild_id)
+
+    async def lock(self, guild_id, *user_ids):
+        config = await self.load(guild_id)
+        config['locked'].update(user_ids)
+        self._dirty.add(guild_id)
+
+    async def unlock(self, guild_id, *user_ids):
+        """Unlocks members, returns the ones that were actually locked."""
+        locked = (await self.load(guild_id))['locked']
+        removed = locked.intersection(user_ids)
+        if removed:
+            locked.difference_update(removed)
+            self._dirty.add(guild_id)
+        return removed
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        try:
+            rows = []
+            for guild_id in dirty:
+                config = self._configs.get(guild_id)
+                if config is None:
+                    continue  # dirty guilds aren't evicted, but don't lose the batch over one that was
+                rows.append((guild_id, *(list(config[c]) if c == 'locked' else config[c] for c in columns)))
+            if not rows:
+                return
+            async with self.pool.acquire() as con:
+                async with con.transaction():
+                    await con.executemany(upsert_query, rows)
+                    await con.execute(notify_query, self.id, [row[0] for row in rows])
+        except Exception:
+            self._dirty |= {guild_id for guild_id in dirty if guild_id in self._configs}  # try again next time
+            raise
+
+    async def close(self):
+        self._closed = True
+        if self._relisten_task is not None:
+            self._relisten_task.cancel()
+        await super().close()
+        if self._listener is not None:
+            await self._listener.remove_listener('config_changed', self._on_notify)
+            if hasattr(self._listener, 'remove_termination_listener'):
+                self._listener.remove_termination_listener(self._on_terminate)
+            await self.pool.release(self._listener)
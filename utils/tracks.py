@@ -0,0 +1,114 @@
+import asyncio
+import itertools
+from collections import OrderedDict, deque
+
+
+class QueueFull(Exception):
+    pass
+
+
+class TrackQueue:
+    """A guild's song queue.
+    Every song gets an id that stays the same while it's queued, so it can be
+    removed without its position shifting under the user. Appending, popping
+    the next song and removing by id are O(1), and each requester's songs are
+    indexed so their songs can be listed or removed without a scan.
+    """
+    def __init__(self):
+        self._songs = OrderedDict()  # song id -> song, in queue order
+        self._by_requester = {}  # requester id -> OrderedDict of song id -> song
+        self._ids = itertools.count(1)
+        self._getters = deque()
+        self.version = 0  # bumped on every change, for things that cache a rendered queue
+
+    def __len__(self):
+        return len(self._songs)
+
+    def __iter__(self):
+        return iter(self._songs.values())
+
+    def empty(self):
+        return not self._songs
+
+    def _changed(self):
+        self.version += 1
+
+    def put(self, song, *, maxsize=None):
+        """Appends a song, raising QueueFull if the queue already holds `maxsize` songs."""
+        if maxsize and maxsize > 0 and len(self._songs) >= maxsize:
+            raise QueueFull(maxsize)
+
+        song.id = next(self._ids)
+        self._songs[song.id] = song
+        self._by_requester.setdefault(song.requester.id, OrderedDict())[song.id] = song
+        self._changed()
+
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+
+    def _unlink(self, song):
+        songs = self._by_requester[song.requester.id]
+        del songs[song.id]
+        if not songs:
+            del self._by_requester[song.requester.id]
+        self._changed()
+
+    def get_nowait(self):
+        _, song = self._songs.popitem(last=False)
+        self._unlink(song)
+        return song
+
+    async def get(self):
+        while not self._songs:
+            getter = asyncio.get_event_loop().create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except asyncio.CancelledError:
+                getter.cancel()
+                raise
+        return self.get_nowait()
+
+    def remove(self, song):
+        del self._songs[song.id]
+        self._unlink(song)
+
+    def clear(self):
+        """Empties the queue, returning the songs that were in it."""
+        songs = list(self._songs.values())
+        self._songs.clear()
+        self._by_requester.clear()
+        self._changed()
+        return songs
+
+    def find(self, song_id):
+        return self._songs.get(song_id)
+
+    def at(self, position):
+        """Returns the song at a 1-indexed position, or None."""
+        if position < 1 or position > len(self._songs):
+            return None
+        return next(itertools.islice(self._songs.values(), position - 1, None))
+
+    def peek(self, n):
+        """Returns the next `n` songs without removing them."""
+        return list(itertools.islice(self._songs.values(), n))
+
+    def slice(self, start, stop):
+        return list(itertools.islice(self._songs.values(), start, stop))
+
+    def by_requester(self, user_id):
+        songs = self._by_requester.get(user_id)
+        return list(songs.values()) if songs else []
+
+    def count_by(self, user_id):
+        return len(self._by_requester.get(user_id, ()))
+
+    def last_by(self, user_id):
+        songs = self._by_requester.get(user_id)
+        if not songs:
+            return None
+        return songs[next(reversed(songs))]
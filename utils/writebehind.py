@@ -0,0 +1,40 @@
+import asyncio
+
+
+class WriteBehind:
+    """Mixin for stores that keep changes in memory and write them out in batches.
+    Subclasses set `interval` and `loop` and implement `flush`, which runs every
+    `interval` seconds and once more on close. A failed flush is logged with
+    `flush_error` and tried again next time.
+    """
+    interval = 5
+    loop = None
+    flush_error = "Couldn't write changes"
+    _task = None
+
+    def start(self):
+        self._task = self.loop.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise  # an Exception before 3.8, stop() has to end the loop
+            except Exception as e:
+                print(f"{self.flush_error}:\n    {e}")
+
+    async def flush(self):
+        raise NotImplementedError
+
+    async def stop(self):
+        """Stops the loop, waiting out a flush it was cancelled in the middle of."""
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.wait([task])
+
+    async def close(self):
+        await self.stop()
+        await self.flush()